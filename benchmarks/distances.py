@@ -0,0 +1,78 @@
+"""
+Microbenchmark of distances from points to cities: per pair haversine over
+City instances against cities_light.distance.CityCoordinates.
+
+Usage, from the root of the repository::
+
+    python benchmarks/distances.py [number of cities] [number of points]
+"""
+
+import os
+import random
+import sys
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure(DATABASES={'default': {
+    'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+
+from cities_light.distance import CityCoordinates
+from cities_light.geohash import haversine
+from cities_light.models import City
+
+
+def naive_nearest(cities, points):
+    return [min(cities, key=lambda city: haversine(latitude, longitude,
+        city.latitude, city.longitude)).pk for latitude, longitude in points]
+
+
+def naive_within(cities, points, kilometers):
+    return [[city.pk for city in cities if haversine(latitude, longitude,
+        city.latitude, city.longitude) <= kilometers]
+        for latitude, longitude in points]
+
+
+def main(count, point_count):
+    rng = random.Random(0)
+
+    # coordinates come from the database as decimals
+    cities = [City(pk=i + 1,
+        latitude=Decimal('%.5f' % rng.uniform(-60, 70)),
+        longitude=Decimal('%.5f' % rng.uniform(-180, 180)))
+        for i in range(count)]
+    points = [(rng.uniform(-60, 70), rng.uniform(-180, 180))
+        for i in range(point_count)]
+    latitudes, longitudes = map(list, zip(*points))
+
+    coordinates = CityCoordinates([c.pk for c in cities],
+        [float(c.latitude) for c in cities],
+        [float(c.longitude) for c in cities])
+
+    assert naive_nearest(cities, points) == coordinates.nearest(
+        latitudes, longitudes)[0][:, 0].tolist()
+    assert naive_within(cities, points[:1], 500)[0] == sorted(
+        coordinates.within(latitudes[0], longitudes[0], 500).tolist())
+
+    cases = (
+        ('naive nearest', lambda: naive_nearest(cities, points)),
+        ('vectorized nearest', lambda: coordinates.nearest(latitudes,
+            longitudes, k=1)),
+        ('vectorized top 10', lambda: coordinates.nearest(latitudes,
+            longitudes, k=10)),
+        ('naive within 500km', lambda: naive_within(cities, points, 500)),
+        ('vectorized within', lambda: [coordinates.within(latitude,
+            longitude, 500) for latitude, longitude in points]),
+    )
+
+    for name, case in cases:
+        seconds = min(timeit.repeat(case, number=1, repeat=3))
+        print '%-20s %8.3fs %12d pairs/s' % (name, seconds,
+            count * point_count / seconds)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 20)
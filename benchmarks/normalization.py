@@ -0,0 +1,66 @@
+# -*- encoding: utf-8 -*-
+"""
+Microbenchmark of to_ascii() and to_search(): plain, memoized and batch
+implementations, on names which repeat like they do in geonames files.
+
+Usage, from the root of the repository::
+
+    python benchmarks/normalization.py [number of names]
+"""
+
+import os
+import random
+import sys
+import timeit
+import unicodedata
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from django.conf import settings
+settings.configure(DATABASES={'default': {
+    'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+
+from django.utils.encoding import force_unicode
+
+from cities_light.models import (to_search, to_ascii_batch,
+    to_search_batch, ALPHA_REGEXP)
+
+
+def plain_to_ascii(value):
+    if isinstance(value, str):
+        value = force_unicode(value)
+
+    return unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
+
+
+def plain_to_search(value):
+    return ALPHA_REGEXP.sub('', plain_to_ascii(value)).lower()
+
+
+def main(count):
+    # a few names are very common and most are rare, like in geonames files
+    rng = random.Random(0)
+    names = [u'Saint-Étienne-du-Rouvray %s' % int(rng.paretovariate(0.25))
+        for i in range(count)]
+
+    assert [plain_to_search(n) for n in names] == to_search_batch(names)
+    assert [plain_to_search(n) for n in names] == map(to_search, names)
+
+    cases = (
+        ('plain to_ascii()', lambda: map(plain_to_ascii, names)),
+        ('to_ascii_batch()', lambda: to_ascii_batch(names)),
+        ('plain to_search()', lambda: map(plain_to_search, names)),
+        ('memoized to_search()', lambda: map(to_search, names)),
+        ('to_search_batch()', lambda: to_search_batch(names)),
+    )
+
+    def setup():
+        to_search.cache_clear()
+
+    for name, case in cases:
+        seconds = min(timeit.repeat(case, setup, number=1, repeat=3))
+        print '%-22s %8.3fs %10d names/s' % (name, seconds, count / seconds)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -1,5 +1,3 @@
-from copy import copy
-
 from django.contrib import admin
 from django.contrib.admin.views.main import ChangeList
 
@@ -56,10 +54,18 @@ admin.site.register(Region, RegionAdmin)
 
 class CityChangeList(ChangeList):
     def get_query_set(self, request):
-        if 'q' in request.GET.keys():
-            request.GET = copy(request.GET)
-            request.GET['q'] = to_search(request.GET['q'])
-        return super(CityChangeList, self).get_query_set(request)
+        """
+        Search with City.objects.search() rather than search_fields.
+        """
+        query, self.query = self.query, ''
+        try:
+            queryset = super(CityChangeList, self).get_query_set(request)
+        finally:
+            self.query = query
+
+        if query:
+            queryset = queryset.search(query)
+        return queryset
 
 
 class CityAdmin(admin.ModelAdmin):
@@ -0,0 +1,74 @@
+"""
+Helpers to write many rows with few statements, used by the cities_light
+command when it runs with --bulk.
+
+bulk_update()
+    Django has QuerySet.bulk_create() but nothing to update a set of
+    instances with different values in a single statement. This function
+    issues one UPDATE ... SET column = CASE pk WHEN ... END per batch of
+    instances instead of one UPDATE per instance.
+
+    Like bulk_create(), it does **not** send any signal: callers should run
+    whatever pre_save logic they need themselves.
+"""
+
+from django.db import connections, router, transaction
+
+__all__ = ['bulk_update']
+
+
+def bulk_update(model, instances, fields, using=None):
+    """
+    Save the given fields of all instances using as few UPDATE statements as
+    the database backend allows.
+    """
+    instances = list(instances)
+    if not instances:
+        return
+
+    if using is None:
+        using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+
+    pk = model._meta.pk
+    fields = [model._meta.get_field(name) for name in fields]
+
+    # each instance takes a pair of parameters per field, plus its pk in the
+    # WHERE clause
+    batch_size = connection.ops.bulk_batch_size([pk] + fields * 2,
+        instances)
+
+    for start in range(0, len(instances), batch_size):
+        batch = instances[start:start + batch_size]
+        pks = [pk.get_db_prep_value(i.pk, connection=connection)
+            for i in batch]
+
+        assignments = []
+        params = []
+        for field in fields:
+            value_sql = '%s'
+            if connection.vendor == 'postgresql':
+                # parameters are untyped literals for postgres, which would
+                # otherwise resolve the whole CASE as text
+                value_sql = 'CAST(%%s AS %s)' % field.db_type(
+                    connection=connection)
+
+            whens = []
+            for instance_pk, instance in zip(pks, batch):
+                whens.append('WHEN %%s THEN %s' % value_sql)
+                params.append(instance_pk)
+                params.append(field.get_db_prep_save(
+                    getattr(instance, field.attname), connection=connection))
+
+            assignments.append('%s = CASE %s %s END' % (qn(field.column),
+                qn(pk.column), ' '.join(whens)))
+
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table), ', '.join(assignments), qn(pk.column),
+            ', '.join(['%s'] * len(pks)))
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params + pks)
+
+    transaction.commit_unless_managed(using=using)
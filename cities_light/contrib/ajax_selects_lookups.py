@@ -5,12 +5,18 @@ Register the lookups in settings.AJAX_LOOKUP_CHANNELS, add::
 
     'cities_light_country': ('cities_light.lookups', 'CountryLookup'),
     'cities_light_city': ('cities_light.lookups', 'CityLookup'),
+
+If settings.CITIES_LIGHT_PREFIX_INDEX is True, the lookups find the limit
+first matches in cities_light.prefix_index and only query the database to
+load them.
 """
 
 from ajax_select import LookupChannel
 from django.db.models import Q
 
 from ..models import *
+from ..settings import PREFIX_INDEX
+from .. import prefix_index
 
 
 class StandardLookupChannel(LookupChannel):
@@ -18,6 +24,17 @@ class StandardLookupChannel(LookupChannel):
     Honnestly I'm not sure why this is here.
     """
 
+    # maximum number of results found in the prefix index
+    limit = 20
+
+    def get_indexed_query(self, q):
+        """
+        Return the instances of the limit first matches of q in the prefix
+        index of the model.
+        """
+        return prefix_index.in_order(self.model.objects.all(),
+            prefix_index.search(self.model, q, self.limit))
+
     def format_match(self, obj):
         """ (HTML) formatted item for displaying item in the dropdown """
         return self.get_result(obj)
@@ -37,6 +54,9 @@ class CountryLookup(StandardLookupChannel):
     model = Country
 
     def get_query(self, q, request):
+        if PREFIX_INDEX:
+            return self.get_indexed_query(q)
+
         return Country.objects.filter(
             Q(name__icontains=q) |
             Q(name_ascii__icontains=q)
@@ -51,6 +71,9 @@ class RegionLookup(StandardLookupChannel):
     model = Region
 
     def get_query(self, q, request):
+        if PREFIX_INDEX:
+            return self.get_indexed_query(q)
+
         return Region.objects.filter(
             Q(name__icontains=q) |
             Q(name_ascii__icontains=q)
@@ -59,10 +82,12 @@ class RegionLookup(StandardLookupChannel):
 
 class CityLookup(StandardLookupChannel):
     """
-    Lookup channel for City, hits name and search_names.
+    Lookup channel for City, hits its search keys.
     """
     model = City
 
     def get_query(self, q, request):
-        return City.objects.filter(search_names__icontains=q
-            ).select_related('country').distinct()
+        if PREFIX_INDEX:
+            return self.get_indexed_query(q)
+
+        return City.objects.search(q).select_related('country')
@@ -1,17 +1,63 @@
 from ..models import Country, Region, City
+from ..settings import PREFIX_INDEX
+from .. import prefix_index
 
 import autocomplete_light
 
 
-class CityAutocomplete(autocomplete_light.AutocompleteModelBase):
+class PrefixIndexAutocompleteMixin(object):
+    """
+    Find choices in cities_light.prefix_index if
+    settings.CITIES_LIGHT_PREFIX_INDEX is True, in the order of the index.
+    """
+
+    def choices_for_request(self):
+        q = self.request.GET.get('q', '')
+        if not PREFIX_INDEX or not q:
+            return super(PrefixIndexAutocompleteMixin,
+                self).choices_for_request()
+
+        return self.choices_from_index(q)
+
+    def choices_from_index(self, q):
+        """
+        Return the limit_choices first matches of q in the prefix index
+        which are not excluded by the request, with a single query.
+        """
+        exclude = set(self.request.GET.getlist('exclude'))
+        pks = [pk for pk in prefix_index.search(self.choices.model, q,
+            self.limit_choices + len(exclude)) if str(pk) not in exclude]
+
+        return prefix_index.in_order(self.choices,
+            pks[:self.limit_choices])
+
+
+class CityAutocomplete(PrefixIndexAutocompleteMixin,
+        autocomplete_light.AutocompleteModelBase):
     search_fields = ('search_names',)
 
+    def choices_for_request(self):
+        """
+        Return the cities of which a search key starts with the q GET
+        argument, using City.objects.search() rather than search_fields.
+        """
+        q = self.request.GET.get('q', '')
+        if PREFIX_INDEX and q:
+            return self.choices_from_index(q)
+
+        exclude = self.request.GET.getlist('exclude')
+
+        choices = self.choices.search(q).exclude(pk__in=exclude)
+        return self.order_choices(choices)[0:self.limit_choices]
+
 
-class RegionAutocomplete(autocomplete_light.AutocompleteModelBase):
+class RegionAutocomplete(PrefixIndexAutocompleteMixin,
+        autocomplete_light.AutocompleteModelBase):
     search_fields = ('name', 'name_ascii')
 
 
-class CountryAutocomplete(autocomplete_light.AutocompleteModelBase):
+class CountryAutocomplete(PrefixIndexAutocompleteMixin,
+        autocomplete_light.AutocompleteModelBase):
     search_fields = ('name', 'name_ascii')
 
 
@@ -4,6 +4,7 @@ Couple djangorestframework and cities_light.
 It defines a urlpatterns variables, with the following urls:
 
 - cities_light_api_city_list
+- cities_light_api_city_nearest
 - cities_light_api_city_detail
 - cities_light_api_region_list
 - cities_light_api_region_detail
@@ -20,12 +21,17 @@ And that's all !
 
 from django.conf.urls.defaults import patterns, url
 from django.core import urlresolvers
+from django.core.exceptions import ImproperlyConfigured
 
-from djangorestframework.views import ModelView, ListModelView
+from djangorestframework import status
+from djangorestframework.views import View, ModelView, ListModelView
 from djangorestframework.mixins import InstanceMixin, ReadModelMixin
 from djangorestframework.resources import ModelResource
+from djangorestframework.response import ErrorResponse
 
 from ..models import Country, Region, City
+from ..settings import BATCH_SIZE
+from .. import spatial
 
 
 class CityResource(ModelResource):
@@ -114,17 +120,110 @@ class CityListModelView(CitiesLightListModelView):
     ListModelView for City.
     """
 
+    def get_queryset(self):
+        """
+        Allows a GET param, 'q', to be used against the search keys.
+        """
+        queryset = super(CityListModelView, self).get_queryset()
+
+        if 'q' in self.request.GET.keys():
+            queryset = queryset.search(self.request.GET['q'])
+
+        return queryset
+
     def get_query_kwargs(self, request, *args, **kwargs):
         """
-        Allows a GET param, 'q', to be used against search_names.
+        Do not filter name_ascii with 'q', get_queryset() uses it.
         """
-        kwargs = super(ListModelView, self).get_query_kwargs(request, *args,
+        return super(ListModelView, self).get_query_kwargs(request, *args,
             **kwargs)
 
-        if 'q' in request.GET.keys():
-            kwargs['search_names__icontains'] = request.GET['q']
 
-        return kwargs
+class NearestCityView(View):
+    """
+    Batch reverse geocoding. POST a JSON object like::
+
+        {"points": [[48.85, 2.35], [45.75, 4.85]], "k": 1}
+
+    The response has, for each point, the list of the k (default 1) nearest
+    cities with their id, display_name and distance in kilometers, nearest
+    first. Cities are found in the in-process index of
+    cities_light.spatial, which requires numpy: without it, the response is
+    a 503 error.
+    """
+
+    # maximum number of points of a request, and of cities per point
+    max_points = 1000
+    max_k = 10
+
+    def bad_request(self, detail):
+        return ErrorResponse(status.HTTP_400_BAD_REQUEST, {'detail': detail})
+
+    def get_points(self, content):
+        """
+        Return the list of (latitude, longitude) of the request, raise an
+        ErrorResponse if they are invalid.
+        """
+        try:
+            points = [(float(latitude), float(longitude))
+                for latitude, longitude in content['points']]
+        except (KeyError, TypeError, ValueError):
+            raise self.bad_request(
+                'points should be a list of [latitude, longitude]')
+
+        if len(points) > self.max_points:
+            raise self.bad_request('At most %s points are allowed' %
+                self.max_points)
+
+        for latitude, longitude in points:
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                raise self.bad_request('Invalid coordinates: %s, %s' % (
+                    latitude, longitude))
+
+        return points
+
+    def get_k(self, content):
+        """
+        Return the number of cities to find per point.
+        """
+        try:
+            k = int(content.get('k', 1))
+        except (TypeError, ValueError):
+            k = 0
+
+        if not 1 <= k <= self.max_k:
+            raise self.bad_request('k should be between 1 and %s' %
+                self.max_k)
+
+        return k
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(self.CONTENT, dict):
+            raise self.bad_request('Expected a JSON object')
+
+        points = self.get_points(self.CONTENT)
+        k = self.get_k(self.CONTENT)
+
+        try:
+            index = spatial.get_index()
+        except ImproperlyConfigured as e:
+            # numpy is not installed
+            raise ErrorResponse(status.HTTP_503_SERVICE_UNAVAILABLE,
+                {'detail': unicode(e)})
+
+        results = index.nearest_many(points, k)
+
+        # display names of all the cities found, by batches of pks
+        pks = list(set(pk for result in results for pk, distance in result))
+        display_names = {}
+        for start in range(0, len(pks), BATCH_SIZE):
+            display_names.update(City.objects.filter(
+                pk__in=pks[start:start + BATCH_SIZE]).values_list('pk',
+                'display_name'))
+
+        return [[{'id': pk, 'display_name': display_names.get(pk, u''),
+            'distance': distance} for pk, distance in result]
+            for result in results]
 
 urlpatterns = patterns('',
     url(
@@ -132,6 +231,11 @@ urlpatterns = patterns('',
         CityListModelView.as_view(resource=CityResource),
         name='cities_light_api_city_list',
     ),
+    url(
+        r'^city/nearest/$',
+        NearestCityView.as_view(),
+        name='cities_light_api_city_nearest',
+    ),
     url(
         r'^city/(?P<pk>[^/]+)/$',
         DetailView.as_view(resource=CityResource),
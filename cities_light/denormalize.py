@@ -0,0 +1,137 @@
+"""
+Denormalization of regions and cities in bulk.
+
+The pre_save receivers of cities_light.models set display_name,
+search_names, name_ascii and the country of cities for each saved instance,
+loading its region and country on the way, and a post_save receiver writes
+the CitySearchKeys of saved cities. When importing many cities, this is
+deferred: defer_denormalization() disconnects these receivers and
+denormalize() does the same for all regions and cities afterwards, with a
+query to read and a few queries to write each batch.
+"""
+
+import contextlib
+import itertools
+
+from django.db.models import signals
+
+from .bulk import bulk_update
+from .models import (Country, Region, City, set_display_name, city_country,
+    city_search_names, city_search_keys, get_names, get_search_names,
+    build_search_names, set_search_keys, to_ascii, to_search_batch)
+from .settings import BATCH_SIZE
+from .signals import is_connected
+
+__all__ = ['DEFERRED_RECEIVERS', 'defer_denormalization', 'denormalize']
+
+# (signal, receiver, sender) of the receivers which query the region or
+# country of the instance, or its search keys
+DEFERRED_RECEIVERS = (
+    (signals.pre_save, set_display_name, Region),
+    (signals.pre_save, set_display_name, City),
+    (signals.pre_save, city_country, City),
+    (signals.pre_save, city_search_names, City),
+    (signals.post_save, city_search_keys, City),
+)
+
+
+@contextlib.contextmanager
+def defer_denormalization():
+    """
+    Context manager disconnecting DEFERRED_RECEIVERS, which are connected
+    again on exit. Run denormalize() afterwards.
+    """
+    disconnected = []
+    for signal, receiver, sender in DEFERRED_RECEIVERS:
+        if is_connected(signal, receiver, sender):
+            signal.disconnect(receiver, sender=sender)
+            disconnected.append((signal, receiver, sender))
+
+    try:
+        yield
+    finally:
+        for signal, receiver, sender in disconnected:
+            signal.connect(receiver, sender=sender)
+
+
+def _batches(model, batch_size):
+    """
+    Yield lists of batch_size instances of model, ordered by pk.
+    """
+    queryset = model.objects.order_by('pk')
+    batch = list(queryset[:batch_size])
+
+    while batch:
+        yield batch
+        batch = list(queryset.filter(pk__gt=batch[-1].pk)[:batch_size])
+
+
+def denormalize(batch_size=BATCH_SIZE):
+    """
+    Set display_name and name_ascii of all regions, then display_name,
+    search_names, name_ascii and country of all cities, like the pre_save
+    receivers would, save the instances which changed and write the
+    CitySearchKeys of all cities.
+
+    Countries and regions are loaded once. After each batch of batch_size
+    instances, (model class, number of instances) is yielded so that callers
+    may commit and report progress.
+    """
+    countries = dict((c.pk, c) for c in Country.objects.all())
+    country_names = dict((pk, get_search_names(country))
+        for pk, country in countries.items())
+
+    regions = {}
+    for batch in _batches(Region, batch_size):
+        changed = []
+        for region in batch:
+            before = (region.display_name, region.name_ascii)
+
+            region.country = countries[region.country_id]
+            region.display_name = region.get_display_name()
+            if not region.name_ascii:
+                region.name_ascii = to_ascii(region.name)
+
+            if (region.display_name, region.name_ascii) != before:
+                changed.append(region)
+
+            regions[region.pk] = region
+
+        bulk_update(Region, changed, ['display_name', 'name_ascii'])
+        yield Region, len(batch)
+
+    region_names = dict((pk, get_search_names(region))
+        for pk, region in regions.items())
+
+    for batch in _batches(City, batch_size):
+        # normalize the names of the whole batch at once
+        names = [get_names(city) for city in batch]
+        search_names = iter(to_search_batch(itertools.chain(*names)))
+
+        changed = []
+        for city, city_names in zip(batch, names):
+            before = (city.display_name, city.search_names,
+                city.name_ascii, city.country_id)
+
+            if city.region_id:
+                city.region = regions[city.region_id]
+                if not city.country_id:
+                    city.country_id = city.region.country_id
+
+            city.country = countries[city.country_id]
+            city.display_name = city.get_display_name()
+            city.search_names = build_search_names(
+                list(itertools.islice(search_names, len(city_names))),
+                region_names.get(city.region_id, []),
+                country_names[city.country_id])
+            if not city.name_ascii:
+                city.name_ascii = to_ascii(city.name)
+
+            if (city.display_name, city.search_names, city.name_ascii,
+                    city.country_id) != before:
+                changed.append(city)
+
+        bulk_update(City, changed, ['display_name', 'search_names',
+            'name_ascii', 'country'])
+        set_search_keys(batch, batch_size)
+        yield City, len(batch)
@@ -0,0 +1,127 @@
+"""
+Vectorized distances between points and cities, with numpy.
+
+CityCoordinates loads the pks and coordinates of the cities of a queryset
+into arrays with a single query, without instantiating models. Distances
+from one or many points to all of them are then computed at once, as
+haversine() accepts arrays and broadcasts them::
+
+    coordinates = CityCoordinates.from_queryset(
+        City.objects.filter(country__code2='FR'))
+    distances = coordinates.distances([48.85, 45.75], [2.35, 4.85])
+    pks = coordinates.within(48.85, 2.35, 50)
+    pks, distances = coordinates.nearest([48.85, 45.75], [2.35, 4.85], k=3)
+
+A distance matrix holds a float for each point and city: split very large
+batches of points to bound memory.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .geohash import EARTH_RADIUS
+
+__all__ = ['haversine', 'load_coordinates', 'CityCoordinates']
+
+
+def haversine(latitudes1, longitudes1, latitudes2, longitudes2):
+    """
+    Return the great-circle distances between points, in kilometers.
+    Arguments are degrees, as numbers or arrays broadcast together.
+    """
+    latitudes1, longitudes1, latitudes2, longitudes2 = [
+        numpy.radians(numpy.asarray(values, dtype=numpy.float64))
+        for values in (latitudes1, longitudes1, latitudes2, longitudes2)]
+
+    a = (numpy.sin((latitudes2 - latitudes1) / 2) ** 2 +
+        numpy.cos(latitudes1) * numpy.cos(latitudes2) *
+        numpy.sin((longitudes2 - longitudes1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+
+
+def load_coordinates(queryset):
+    """
+    Return the arrays of the pks, latitudes and longitudes of the cities of
+    queryset which have coordinates.
+    """
+    if numpy is None:
+        raise ImproperlyConfigured('Install numpy to load city coordinates')
+
+    rows = list(queryset.filter(latitude__isnull=False,
+        longitude__isnull=False).values_list('pk', 'latitude',
+        'longitude').iterator())
+
+    pks = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+    coordinates = numpy.array([(row[1], row[2]) for row in rows],
+        dtype=numpy.float64).reshape((len(rows), 2))
+
+    return pks, coordinates[:, 0], coordinates[:, 1]
+
+
+class CityCoordinates(object):
+    """
+    pks and coordinates of cities, in numpy arrays.
+    """
+
+    def __init__(self, pks, latitudes, longitudes):
+        if numpy is None:
+            raise ImproperlyConfigured(
+                'Install numpy to use cities_light.distance')
+
+        self.pks = numpy.asarray(pks, dtype=numpy.int64)
+        self.latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+        self.longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        return cls(*load_coordinates(queryset))
+
+    def __len__(self):
+        return len(self.pks)
+
+    def distances(self, latitudes, longitudes):
+        """
+        Return the matrix of the distances in kilometers from each point to
+        each city, with a row per point. A single point gives a single row.
+        """
+        latitudes = numpy.atleast_1d(numpy.asarray(latitudes,
+            dtype=numpy.float64))
+        longitudes = numpy.atleast_1d(numpy.asarray(longitudes,
+            dtype=numpy.float64))
+
+        return haversine(latitudes[:, numpy.newaxis],
+            longitudes[:, numpy.newaxis], self.latitudes, self.longitudes)
+
+    def within(self, latitude, longitude, kilometers):
+        """
+        Return the array of the pks of the cities at most the given distance
+        away from the point, nearest first.
+        """
+        distances = self.distances(latitude, longitude)[0]
+        indices = numpy.flatnonzero(distances <= kilometers)
+        return self.pks[indices[numpy.argsort(distances[indices])]]
+
+    def nearest(self, latitudes, longitudes, k=1):
+        """
+        Return the (m, k) arrays of the pks of the k cities nearest to each
+        of the m points, nearest first, and of their distances.
+        """
+        distances = self.distances(latitudes, longitudes)
+        k = min(k, len(self.pks))
+        rows = numpy.arange(len(distances))[:, numpy.newaxis]
+
+        if k < len(self.pks):
+            # only sort the k smallest distances of each row
+            indices = numpy.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            indices = numpy.tile(numpy.arange(k), (len(distances), 1))
+
+        order = numpy.argsort(distances[rows, indices], axis=1)
+        indices = indices[rows, order]
+
+        return self.pks[indices], distances[rows, indices]
@@ -4,3 +4,11 @@ class InvalidItems(Exception):
     reciever raises this exception.
     """
     pass
+
+
+class InvalidSource(Exception):
+    """
+    Raised when a downloaded source is not a valid archive, ie. if its
+    download was truncated.
+    """
+    pass
@@ -0,0 +1,183 @@
+"""
+Geohashes of coordinates, and the geohash ranges covering a bounding box.
+
+A geohash interleaves the bits of the longitude and of the latitude and
+encodes them in base 32: points close to each other usually share a long
+prefix, and all the points of a geohash cell have geohashes starting with
+the geohash of the cell. City.geohash is indexed, so the cities of a few
+cells are found with a few index range scans, see CityQuerySet.in_bbox().
+"""
+
+import math
+
+__all__ = ['encode', 'decode', 'bbox_ranges', 'haversine', 'EARTH_RADIUS',
+    'PRECISION']
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# length of City.geohash, cells are about 4 by 2 centimeters
+PRECISION = 12
+
+# mean radius of the earth, in kilometers
+EARTH_RADIUS = 6371.0088
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    """
+    Return the geohash of the given coordinates, in degrees.
+    """
+    south, north = -90., 90.
+    west, east = -180., 180.
+    latitude = float(latitude)
+    longitude = float(longitude)
+
+    geohash = []
+    bits = 0
+    value = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            middle = (west + east) / 2
+            if longitude >= middle:
+                value = value * 2 + 1
+                west = middle
+            else:
+                value = value * 2
+                east = middle
+        else:
+            middle = (south + north) / 2
+            if latitude >= middle:
+                value = value * 2 + 1
+                south = middle
+            else:
+                value = value * 2
+                north = middle
+
+        even = not even
+        bits += 1
+        if bits == 5:
+            geohash.append(BASE32[value])
+            bits = 0
+            value = 0
+
+    return ''.join(geohash)
+
+
+def decode(geohash):
+    """
+    Return the (south, west, north, east) bounding box of a geohash cell.
+    """
+    south, north = -90., 90.
+    west, east = -180., 180.
+
+    even = True
+    for character in geohash:
+        value = BASE32.index(character)
+        for bit in (16, 8, 4, 2, 1):
+            if even:
+                middle = (west + east) / 2
+                if value & bit:
+                    west = middle
+                else:
+                    east = middle
+            else:
+                middle = (south + north) / 2
+                if value & bit:
+                    south = middle
+                else:
+                    north = middle
+            even = not even
+
+    return south, west, north, east
+
+
+def cell_size(precision):
+    """
+    Return the (height, width) in degrees of the cells of geohashes of the
+    given length.
+    """
+    bits = precision * 5
+    return 180. / 2 ** (bits // 2), 360. / 2 ** (bits - bits // 2)
+
+
+def _cell_indices(start, end, origin, size, count):
+    """
+    Return the indices of the cells of the given size between start and end,
+    counted from origin, at most count.
+    """
+    first = max(0, min(int((start - origin) // size), count - 1))
+    last = max(0, min(int((end - origin) // size), count - 1))
+    return range(first, last + 1)
+
+
+def _next(prefix):
+    """
+    Return the first geohash after all the geohashes starting with prefix,
+    or None if there is none.
+    """
+    while prefix and prefix[-1] == BASE32[-1]:
+        prefix = prefix[:-1]
+
+    if not prefix:
+        return None
+
+    return prefix[:-1] + BASE32[BASE32.index(prefix[-1]) + 1]
+
+
+def bbox_ranges(south, west, north, east, max_cells=16):
+    """
+    Return the sorted list of the (start, stop) ranges of geohashes covering
+    the bounding box, stop being None for a range without end.
+
+    The cells are the smallest geohash cells of which at most max_cells
+    cover the bounding box, and ranges of contiguous cells are merged. If
+    west is greater than east, the box crosses the antimeridian. An empty
+    list means that even the largest cells are too many: all geohashes are
+    to be searched.
+    """
+    cells = None
+    for precision in range(1, PRECISION + 1):
+        height, width = cell_size(precision)
+        rows = _cell_indices(south, north, -90., height, 2 ** (
+            precision * 5 // 2))
+
+        count = int(round(360. / width))
+        if west <= east:
+            columns = _cell_indices(west, east, -180., width, count)
+        else:
+            columns = (_cell_indices(west, 180., -180., width, count) +
+                _cell_indices(-180., east, -180., width, count))
+
+        if len(rows) * len(columns) > max_cells:
+            break
+
+        cells = [encode(-90. + (row + .5) * height,
+            -180. + (column + .5) * width, precision)
+            for row in rows for column in columns]
+
+    if cells is None:
+        return []
+
+    ranges = []
+    for prefix in sorted(set(cells)):
+        stop = _next(prefix)
+        if ranges and ranges[-1][1] == prefix:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((prefix, stop))
+
+    return ranges
+
+
+def haversine(latitude1, longitude1, latitude2, longitude2):
+    """
+    Return the great-circle distance between two points, in kilometers.
+    """
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, map(
+        float, (latitude1, longitude1, latitude2, longitude2)))
+
+    a = (math.sin((latitude2 - latitude1) / 2) ** 2 +
+        math.cos(latitude1) * math.cos(latitude2) *
+        math.sin((longitude2 - longitude1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS * math.asin(min(1., math.sqrt(a)))
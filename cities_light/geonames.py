@@ -1,88 +1,524 @@
-import time
-import urllib
+import email.utils
+import errno
+import json
+import urllib2
 import os
 import os.path
+import gzip
 import zipfile
 import logging
+import mmap
+import multiprocessing
+import shutil
 import sys
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .exceptions import InvalidSource
 from .settings import *
 
 
+def text(value):
+    return value.decode('utf-8')
+
+
+def integer(value):
+    if value:
+        return int(value)
+
+
+def real(value):
+    if value:
+        return float(value)
+
+
+# Columns of each kind of source used by the cities_light command, as
+# (index, converter) pairs. parse() and parse_parallel() only strip and
+# convert these columns, others are None. A converter of None keeps the byte
+# string, which spares a function call.
+COUNTRY_COLUMNS = ((0, None), (1, None), (4, text), (8, None), (9, None),
+    (16, integer))
+REGION_COLUMNS = ((0, None), (1, text), (2, text), (3, integer))
+CITY_COLUMNS = ((0, integer), (1, text), (2, text), (3, text), (4, real),
+    (5, real), (6, None), (7, None), (8, None), (9, None), (10, None),
+    (14, integer))
+# names are only decoded when they are applied
+TRANSLATION_COLUMNS = ((0, integer), (1, integer), (2, None), (3, None),
+    (4, None), (5, None), (6, None), (7, None))
+
+# row filter and columns of the current parse_parallel() worker process
+_worker_filter = None
+_worker_columns = None
+
+
+def _init_worker(row_filter, columns=None):
+    global _worker_filter, _worker_columns
+    _worker_filter = row_filter
+    _worker_columns = columns
+
+
+def _parse_line(line):
+    line = line.strip()
+
+    if len(line) < 1 or line[0] == '#':
+        return None
+
+    return [e.strip() for e in line.split('\t')]
+
+
+def _parse_columns(line, columns, width, row_filter=None):
+    """
+    Return a list of width items with the stripped and converted columns of
+    line, or None for a blank line, a comment or a line rejected by
+    row_filter.
+
+    row_filter gets the fields of the line, which are not stripped nor
+    converted yet.
+    """
+    if not line or line[0] == '#' or line.isspace():
+        return None
+
+    # the columns after width are not split
+    fields = line.split('\t', width)
+    if len(fields) < width:
+        fields.extend([''] * (width - len(fields)))
+
+    if row_filter is not None and not row_filter(fields):
+        return None
+
+    items = [None] * width
+    for index, converter in columns:
+        if converter is None:
+            items[index] = fields[index].strip()
+        else:
+            items[index] = converter(fields[index].strip())
+
+    return items
+
+
+def _parse_range(args):
+    """
+    Parse the lines of file_path between two offsets, in a worker process.
+    """
+    file_path, start, end = args
+
+    with open(file_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        lines = data[start:end].splitlines()
+
+        if _worker_columns is None:
+            rows = [items for items in map(_parse_line, lines)
+                if items is not None]
+
+            if _worker_filter is not None:
+                rows = [items for items in rows if _worker_filter(items)]
+        else:
+            width = max(index for index, converter in _worker_columns) + 1
+            rows = [_parse_columns(line, _worker_columns, width,
+                _worker_filter) for line in lines]
+            rows = [items for items in rows if items is not None]
+    finally:
+        data.close()
+
+    return end - start, rows
+
+
 class Geonames(object):
+    """
+    Download a geonames file and parse its rows.
+
+    Files compressed as .zip, .gz or .xz are read as a stream, they are only
+    extracted into DATA_DIR by parse_parallel() which needs a plain file.
+    """
+
     logger = logging.getLogger('cities_light')
 
+    # approximate size of the byte ranges parsed by parse_parallel() workers
+    chunk_size = 16 * 1024 * 1024
+
+    # size of the reads of parse()
+    read_size = 1024 * 1024
+
+    # size of the reads of download()
+    download_chunk_size = 64 * 1024
+
+    # number of bytes of the file consumed by parse() or parse_parallel(),
+    # compressed bytes for parse() on a compressed file
+    position = 0
+
+    # maximum of position
+    size = 0
+
+    # number of uncompressed bytes of the rows consumed, parse() and
+    # parse_parallel() can start from such an offset
+    offset = 0
+
     def __init__(self, url, force=False):
         if not os.path.exists(DATA_DIR):
             self.logger.info('Creating %s' % DATA_DIR)
-            os.mkdir(DATA_DIR)
+            try:
+                os.mkdir(DATA_DIR)
+            except OSError as e:
+                # another download thread created it
+                if e.errno != errno.EEXIST:
+                    raise
 
         destination_file_name = url.split('/')[-1]
         self.file_path = os.path.join(DATA_DIR,
             destination_file_name)
 
         self.downloaded = self.download(url, self.file_path, force)
+        self.validate()
 
-        # extract the destination file, use the extracted file as new
-        # destination
-        destination_file_name = destination_file_name.replace(
-            'zip', 'txt')
+    def download(self, url, path, force=False):
+        """
+        Download url into path if it changed, return True if it did.
 
-        destination = os.path.join(DATA_DIR, destination_file_name)
-        exists = os.path.exists(destination)
+        Unless force is True, the request is conditional on the Last-Modified
+        and ETag of the previous download, which the server may answer with a
+        304 response. An interrupted download left in path.part is resumed
+        with a Range request. The response is written by chunks of
+        download_chunk_size bytes.
+        """
+        part_path = path + '.part'
+        headers_path = path + '.headers'
 
-        if url.split('.')[-1] == 'zip' and not exists:
-            self.extract(self.file_path, destination_file_name)
+        previous = {}
+        if os.path.exists(headers_path):
+            with open(headers_path, 'r') as f:
+                previous = json.load(f)
 
-        self.file_path = os.path.join(
-            DATA_DIR, destination_file_name)
-
-    def download(self, url, path, force=False):
-        remote_file = urllib.urlopen(url)
-        remote_time = time.strptime(remote_file.headers['last-modified'],
-            '%a, %d %b %Y %H:%M:%S %Z')
-        remote_size = int(remote_file.headers['content-length'])
+        request = urllib2.Request(url)
 
         if os.path.exists(path) and not force:
-            local_time = time.gmtime(os.path.getmtime(path))
-            local_size = os.path.getsize(path)
+            request.add_header('If-Modified-Since',
+                email.utils.formatdate(os.path.getmtime(path), usegmt=True))
+
+            if previous.get('complete') and previous.get('etag'):
+                request.add_header('If-None-Match', previous['etag'])
 
-            if local_time >= remote_time and local_size == remote_size:
-                self.logger.warning(
-                    'Assuming local download is up to date for %s' % url)
+        resume_from = 0
+        if os.path.exists(part_path) and not previous.get('complete'):
+            validator = previous.get('etag') or previous.get('last_modified')
+            if validator:
+                resume_from = os.path.getsize(part_path)
+                request.add_header('Range', 'bytes=%s-' % resume_from)
+                request.add_header('If-Range', validator)
 
+        try:
+            remote_file = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                self.logger.warning('%s was not modified' % url)
                 return False
+            raise
 
-        self.logger.info('Downloading %s into %s' % (url, path))
-        with open(path, 'wb') as local_file:
-            chunk = remote_file.read()
+        remote_time = remote_file.headers.getheader('last-modified')
+        if remote_time:
+            remote_time = email.utils.mktime_tz(
+                email.utils.parsedate_tz(remote_time))
+
+        if remote_file.getcode() != 206:
+            resume_from = 0
+            remote_size = remote_file.headers.getheader('content-length')
+
+            # the server may well ignore conditional requests
+            if os.path.exists(path) and not force and remote_time:
+                local_time = os.path.getmtime(path)
+                local_size = os.path.getsize(path)
+
+                if (local_time >= remote_time and
+                        str(local_size) == remote_size):
+                    self.logger.warning(
+                        'Assuming local download is up to date for %s' % url)
+                    remote_file.close()
+                    return False
+
+        with open(headers_path, 'w') as f:
+            json.dump({
+                'etag': remote_file.headers.getheader('etag'),
+                'last_modified': remote_file.headers.getheader(
+                    'last-modified'),
+                'complete': False,
+            }, f)
+
+        if resume_from:
+            self.logger.info('Resuming download of %s into %s at byte %s' % (
+                url, path, resume_from))
+        else:
+            self.logger.info('Downloading %s into %s' % (url, path))
+
+        with open(part_path, 'ab' if resume_from else 'wb') as local_file:
+            chunk = remote_file.read(self.download_chunk_size)
             while chunk:
                 local_file.write(chunk)
-                chunk = remote_file.read()
+                chunk = remote_file.read(self.download_chunk_size)
+
+        remote_file.close()
+        os.rename(part_path, path)
+
+        if remote_time:
+            # If-Modified-Since of the next download
+            os.utime(path, (remote_time, remote_time))
+
+        with open(headers_path, 'r') as f:
+            headers = json.load(f)
+        headers['complete'] = True
+        with open(headers_path, 'w') as f:
+            json.dump(headers, f)
 
         return True
 
-    def extract(self, zip_path, file_name):
-        destination = os.path.join(DATA_DIR, file_name)
+    @property
+    def compression(self):
+        """
+        Return 'zip', 'gz', 'xz' or None.
+        """
+        extension = self.file_path.split('.')[-1]
+        if extension in ('zip', 'gz', 'xz'):
+            return extension
+
+    def open(self):
+        """
+        Return the downloaded file and a file object of its uncompressed
+        content.
+
+        The first one is the one to tell() the position in the downloaded
+        file, the second one is the one to read.
+        """
+        raw = open(self.file_path, 'rb')
+        compression = self.compression
+
+        if compression == 'zip':
+            zip_file = zipfile.ZipFile(raw)
+            return raw, zip_file.open(self.zip_member(zip_file))
+        elif compression == 'gz':
+            return raw, gzip.GzipFile(fileobj=raw, mode='rb')
+        elif compression == 'xz':
+            if lzma is None:
+                raise ImproperlyConfigured(
+                    'Install backports.lzma to import %s' % self.file_path)
+
+            return raw, lzma.LZMAFile(raw)
+
+        return raw, raw
+
+    def zip_member(self, zip_file):
+        """
+        Return the name of the file to read in zip_file.
+        """
+        names = zip_file.namelist()
+
+        # cities15000.zip contains cities15000.txt
+        name = os.path.basename(self.file_path)[:-3] + 'txt'
+        if name not in names and len(names) == 1:
+            name = names[0]
+
+        return name
+
+    def validate(self):
+        """
+        Raise InvalidSource if the downloaded file is not a readable archive,
+        after removing it so that the next run downloads it again.
+
+        Only the cheap structural checks are made: the central directory of a
+        zip, which is at its end, and the magic bytes of gz and xz files
+        along with the footer of xz files.
+        """
+        compression = self.compression
+        if compression is None:
+            return
+
+        error = None
+        with open(self.file_path, 'rb') as f:
+            if compression == 'zip':
+                try:
+                    zip_file = zipfile.ZipFile(f)
+                    zip_file.getinfo(self.zip_member(zip_file))
+                except (zipfile.BadZipfile, KeyError) as e:
+                    error = str(e)
+            elif compression == 'gz':
+                if f.read(2) != '\x1f\x8b':
+                    error = 'Not a gzipped file'
+            elif compression == 'xz':
+                header = f.read(6)
+                f.seek(0, os.SEEK_END)
+                f.seek(max(f.tell() - 2, 0))
+                if header != '\xfd7zXZ\x00' or f.read(2) != 'YZ':
+                    error = 'Not a complete xz file'
+
+        if error is not None:
+            for path in (self.file_path, self.file_path + '.headers'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+            raise InvalidSource('%s: %s, removed it' % (self.file_path,
+                error))
+
+    def extract(self):
+        """
+        Return the path to the uncompressed file, extract it into DATA_DIR
+        unless it was extracted after the last download.
+        """
+        if self.compression is None:
+            return self.file_path
+
+        destination = self.file_path[:-len(self.compression) - 1]
+        if self.compression == 'zip':
+            destination += '.txt'
+
+        if os.path.exists(destination) and (os.path.getmtime(destination) >=
+                os.path.getmtime(self.file_path)):
+            return destination
+
+        self.logger.info('Extracting %s into %s' % (
+            self.file_path, destination))
+
+        raw, stream = self.open()
+        try:
+            with open(destination + '.tmp', 'wb') as f:
+                shutil.copyfileobj(stream, f, self.read_size)
+        finally:
+            stream.close()
+            raw.close()
+
+        os.rename(destination + '.tmp', destination)
+        return destination
+
+    def parse(self, offset=0, columns=None, row_filter=None):
+        """
+        Yield the rows of the file after offset for which row_filter, if
+        any, returns True.
+
+        Rows are lists of stripped byte strings, unless columns is a
+        sequence of (index, converter) pairs like CITY_COLUMNS: then only
+        these columns are stripped and converted, other items are None. In
+        that case, row_filter is called before, with the fields of the line.
+        """
+        if columns is not None:
+            width = max(index for index, converter in columns) + 1
+
+        self.position = 0
+        self.size = os.path.getsize(self.file_path)
+        self.offset = offset
+
+        raw, stream = self.open()
+        try:
+            if stream is raw:
+                raw.seek(offset)
+            else:
+                while offset > 0:
+                    chunk = stream.read(min(offset, self.read_size))
+                    if not chunk:
+                        break
+                    offset -= len(chunk)
+
+            rest = ''
+            while True:
+                chunk = stream.read(self.read_size)
+                if not chunk:
+                    break
+
+                self.position = raw.tell()
+
+                lines = (rest + chunk).split('\n')
+                rest = lines.pop()
+
+                for line in lines:
+                    self.offset += len(line) + 1
+
+                    if columns is None:
+                        items = _parse_line(line)
+                        if (items is not None and row_filter is not None and
+                                not row_filter(items)):
+                            items = None
+                    else:
+                        items = _parse_columns(line, columns, width,
+                            row_filter)
+
+                    if items is not None:
+                        yield items
+
+            # the end of a zip is not part of the compressed member
+            self.position = self.size
+            self.offset += len(rest)
+
+            if columns is None:
+                items = _parse_line(rest)
+                if (items is not None and row_filter is not None and
+                        not row_filter(items)):
+                    items = None
+            else:
+                items = _parse_columns(rest, columns, width, row_filter)
+
+            if items is not None:
+                yield items
+        finally:
+            stream.close()
+            raw.close()
+
+    def parse_parallel(self, processes, row_filter=None, ordered=True,
+            offset=0, columns=None):
+        """
+        Parse the file in a pool of processes, yield batches of rows.
+
+        The file is split in byte ranges aligned on newlines, each of them is
+        parsed by a worker process which only returns the rows for which
+        row_filter returns True. row_filter and columns, which are like for
+        parse(), must be picklable, they are passed once to each worker
+        process.
 
-        self.logger.info('Extracting %s from %s into %s' % (
-            file_name, zip_path, destination))
+        Batches are yielded in file order unless ordered is False, offset
+        only moves past a batch once the next one is requested.
+        """
+        path = self.extract()
 
-        zip_file = zipfile.ZipFile(zip_path)
-        if zip_file:
-            zip_file.extract(file_name, DATA_DIR)
+        self.position = offset
+        self.size = os.path.getsize(path)
+        self.offset = offset
+        pool = multiprocessing.Pool(processes, _init_worker,
+            (row_filter, columns))
 
-    def parse(self):
-        file = open(self.file_path, 'r')
-        line = True
+        try:
+            results = pool.imap if ordered else pool.imap_unordered
+            for length, rows in results(_parse_range,
+                    self.byte_ranges(path, offset)):
+                self.position += length
+                yield rows
+                self.offset += length
+        finally:
+            pool.terminate()
 
-        for line in file:
-            line = line.strip()
+    def byte_ranges(self, path, start=0):
+        """
+        Return a list of (path, start, end) covering the file from start,
+        each range ending with a newline.
+        """
+        size = os.path.getsize(path)
+        if not size:
+            return []
 
-            if len(line) < 1 or line[0] == '#':
-                continue
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-            yield [e.strip() for e in line.split('\t')]
+        ranges = []
+        try:
+            while start < size:
+                end = data.find('\n', min(start + self.chunk_size, size - 1))
+                end = size if end < 0 else end + 1
+                ranges.append((path, start, end))
+                start = end
+        finally:
+            data.close()
 
-    def num_lines(self):
-        return sum(1 for line in open(self.file_path))
+        return ranges
@@ -0,0 +1,79 @@
+"""
+Bounded memoization of functions of one argument, for python 2 which does
+not have functools.lru_cache.
+"""
+
+import functools
+import threading
+
+__all__ = ['lru_cache']
+
+# fields of the links of the list of cached results, from the least to the
+# most recently used
+PREV, NEXT, KEY, RESULT = 0, 1, 2, 3
+
+
+def lru_cache(maxsize):
+    """
+    Decorator memoizing a function of one hashable argument, keeping the
+    results of the maxsize most recently used arguments.
+
+    Results are kept in a dict and in a circular doubly linked list ordered
+    by use, as in python 3, which makes hits much cheaper than with an
+    OrderedDict. The decorated function has a cache_clear() method, and the
+    original function as __wrapped__.
+    """
+    def decorator(function):
+        cache = {}
+        cache_get = cache.get
+        lock = threading.Lock()
+        root = []
+        root[:] = [root, root, None, None]
+
+        @functools.wraps(function)
+        def wrapper(key):
+            lock.acquire()
+            try:
+                link = cache_get(key)
+                if link is not None:
+                    # move the link to the most recently used end
+                    link_prev, link_next, key, result = link
+                    link_prev[NEXT] = link_next
+                    link_next[PREV] = link_prev
+                    last = root[PREV]
+                    last[NEXT] = root[PREV] = link
+                    link[PREV] = last
+                    link[NEXT] = root
+                    return result
+            finally:
+                lock.release()
+
+            result = function(key)
+
+            lock.acquire()
+            try:
+                if key not in cache:
+                    last = root[PREV]
+                    link = [last, root, key, result]
+                    last[NEXT] = root[PREV] = cache[key] = link
+
+                    if len(cache) > maxsize:
+                        first = root[NEXT]
+                        root[NEXT] = first[NEXT]
+                        first[NEXT][PREV] = root
+                        del cache[first[KEY]]
+            finally:
+                lock.release()
+
+            return result
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                root[:] = [root, root, None, None]
+
+        wrapper.cache_clear = cache_clear
+        wrapper.__wrapped__ = function
+        return wrapper
+
+    return decorator
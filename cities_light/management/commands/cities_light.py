@@ -1,27 +1,36 @@
+import datetime
+import json
+import re
 import os
 import os.path
+import itertools
 import logging
+import time
 import optparse
+import multiprocessing.pool
 import sys
 if sys.platform != 'win32':
     import resource
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
 import progressbar
 
 from django.core.management.base import BaseCommand
 from django.db import transaction, reset_queries
+from django.db.models import signals
 from django.utils.encoding import force_unicode
 
 from ...exceptions import *
 from ...signals import *
+from ...signals import is_connected, has_other_receivers
 from ...models import *
+from ...models import (city_search_keys, set_search_keys,
+    cache_search_names)
 from ...settings import *
-from ...geonames import Geonames
+from ...geonames import (Geonames, COUNTRY_COLUMNS, REGION_COLUMNS,
+    CITY_COLUMNS, TRANSLATION_COLUMNS)
+from ...bulk import bulk_update
+from ...translations import TranslationSpool, TranslationCache
+from ...denormalize import defer_denormalization, denormalize
 
 
 class MemoryUsageWidget(progressbar.ProgressBarWidget):
@@ -31,6 +40,97 @@ class MemoryUsageWidget(progressbar.ProgressBarWidget):
         return '?? kB'
 
 
+class TranslationFilter(object):
+    """
+    Row filter for alternateNames rows: keep rows which translation_parse()
+    would not ignore.
+    """
+
+    def __init__(self, languages, geoname_ids):
+        self.languages = set(languages)
+        self.geoname_ids = geoname_ids
+
+    def __call__(self, items):
+        return (items[2] in self.languages and not any(items[4:8]) and
+            int(items[1]) in self.geoname_ids)
+
+
+class CountryFilter(object):
+    """
+    Row filter for country and region rows, on INCLUDE_COUNTRIES and
+    EXCLUDE_COUNTRIES.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = frozenset(include) if include else None
+        self.exclude = frozenset(exclude or ())
+
+    def __call__(self, items):
+        # code2 of countryInfo.txt rows, code2.code of admin1Codes rows
+        code2 = items[0][:2]
+
+        if self.include is not None and code2 not in self.include:
+            return False
+
+        return code2 not in self.exclude
+
+
+class CityFilter(object):
+    """
+    Row filter for city rows, on INCLUDE_COUNTRIES, EXCLUDE_COUNTRIES,
+    INCLUDE_CITY_TYPES, EXCLUDE_CITY_TYPES and MINIMUM_POPULATION. If
+    non_cities is True, it also rejects the rows filter_non_cities() would.
+    """
+
+    def __init__(self, include_countries=None, exclude_countries=None,
+            include_types=None, exclude_types=None, minimum_population=0,
+            non_cities=False):
+        self.include_countries = (frozenset(include_countries)
+            if include_countries else None)
+        self.exclude_countries = frozenset(exclude_countries or ())
+        self.include_types = (frozenset(include_types) if include_types
+            else None)
+        self.exclude_types = frozenset(exclude_types or ())
+        self.minimum_population = minimum_population or 0
+        self.non_cities = non_cities
+
+    def __call__(self, items):
+        # rows are filtered before they are stripped
+        country = items[8].strip()
+        feature_code = items[7].strip()
+
+        if (self.include_countries is not None and
+                country not in self.include_countries):
+            return False
+
+        if country in self.exclude_countries:
+            return False
+
+        if self.non_cities and 'PPL' not in feature_code:
+            return False
+
+        if (self.include_types is not None and
+                feature_code not in self.include_types):
+            return False
+
+        if feature_code in self.exclude_types:
+            return False
+
+        if self.minimum_population:
+            # city_modify() filters rows parsed with CITY_COLUMNS
+            population = items[14]
+            if isinstance(population, basestring):
+                population = population.strip()
+            try:
+                population = int(population or 0)
+            except ValueError:
+                population = 0
+            if population < self.minimum_population:
+                return False
+
+        return True
+
+
 class Command(BaseCommand):
     args = '''
 [--force-all] [--force-import-all \\]
@@ -53,10 +153,41 @@ It is possible to force the import of files which weren't downloaded using the
 --force-import option:
 
     manage.py --force-import cities15000 --force-import country
+
+Full refreshes of big city files are much faster with the --bulk option, which
+inserts and updates cities by batches of CITIES_LIGHT_BATCH_SIZE rows, and with
+the --parallel option, which parses city and translation files with several
+processes:
+
+    manage.py --bulk --parallel 8
+
+Saving each city also loads its region and country to set its display and
+search names. The --defer-denormalization option sets them for all regions and
+cities by batches once everything is imported. If such an import is
+interrupted, run the cities_light_denormalize command:
+
+    manage.py --bulk --defer-denormalization
+
+Once data is imported, it can be kept up to date with the daily modification
+and deletion files of geonames, published at CITIES_LIGHT_INCREMENTAL_SOURCE:
+
+    manage.py --incremental
     '''.strip()
 
     logger = logging.getLogger('cities_light')
 
+    # minimum number of seconds between two updates of a progress bar
+    progress_interval = 0.5
+
+    # row filters of country, region and city sources, set by handle()
+    country_filter = None
+    region_filter = None
+    city_filter = None
+
+    # False if the city rows are filtered like filter_non_cities() would
+    # and it is the only receiver of city_items_pre_import
+    send_city_items = True
+
     option_list = BaseCommand.option_list + (
         optparse.make_option('--force-import-all', action='store_true',
             default=False, help='Import even if files are up-to-date.'
@@ -76,19 +207,48 @@ It is possible to force the import of files which weren't downloaded using the
         ),
         optparse.make_option('--hack-translations', action='store_true',
             default=False,
-            help='Set this if you intend to import translations a lot'
+            help='Cache parsed translations in DATA_DIR, set this if you '
+                 'intend to import translations a lot'
+        ),
+        optparse.make_option('--bulk', action='store_true', default=False,
+            help='Insert and update cities by batches'
+        ),
+        optparse.make_option('--parallel', type='int', default=0,
+            metavar='PROCESSES',
+            help='Parse city and translation files with this many processes'
+        ),
+        optparse.make_option('--incremental', action='store_true',
+            default=False,
+            help='Only apply the daily changes published since the last '
+                 'incremental import'
+        ),
+        optparse.make_option('--defer-denormalization', action='store_true',
+            default=False,
+            help='Set display names and search names of all regions and '
+                 'cities by batches after importing, instead of when saving '
+                 'each of them'
         ),
     )
 
-    @transaction.commit_on_success
+    @transaction.commit_manually
     def handle(self, *args, **options):
         if not os.path.exists(DATA_DIR):
             self.logger.info('Creating %s' % DATA_DIR)
             os.mkdir(DATA_DIR)
 
-        translation_hack_path = os.path.join(DATA_DIR, 'translation_hack')
-
         self.noinsert = options.get('noinsert', False)
+        self.bulk = options.get('bulk', False)
+        self.parallel = options.get('parallel', 0)
+        self._city_batch = []
+        self.translation_caches = []
+
+        self.country_filter = self.region_filter = CountryFilter(
+            INCLUDE_COUNTRIES, EXCLUDE_COUNTRIES)
+        self.city_filter = CityFilter(INCLUDE_COUNTRIES, EXCLUDE_COUNTRIES,
+            INCLUDE_CITY_TYPES, EXCLUDE_CITY_TYPES, MINIMUM_POPULATION,
+            is_connected(city_items_pre_import, filter_non_cities))
+        self.send_city_items = has_other_receivers(city_items_pre_import,
+            filter_non_cities)
         self.widgets = [
             'RAM used: ',
             MemoryUsageWidget(),
@@ -99,6 +259,94 @@ It is possible to force the import of files which weren't downloaded using the
             progressbar.Bar(),
         ]
 
+        try:
+            if options.get('defer_denormalization', False):
+                with defer_denormalization():
+                    self.data_import(options)
+                self.denormalize()
+            else:
+                with cache_search_names():
+                    self.data_import(options)
+        except:
+            transaction.rollback()
+            raise
+        else:
+            transaction.commit()
+
+    def data_import(self, options):
+        if options.get('incremental', False):
+            self.incremental_import()
+        else:
+            self.sources_import(options)
+
+    def denormalize(self):
+        '''
+        Denormalize all regions and cities, committing after each batch.
+        '''
+        self.logger.info('Denormalizing regions and cities')
+
+        maxval = Region.objects.count() + City.objects.count()
+        progress = progressbar.ProgressBar(maxval=max(maxval, 1),
+            widgets=self.widgets)
+
+        i = 0
+        for model, count in denormalize():
+            transaction.commit()
+
+            i += count
+            progress.update(i)
+
+        progress.finish()
+
+    def sources_import(self, options):
+        '''
+        Download and import SOURCES.
+
+        All sources are downloaded at the same time, by DOWNLOAD_THREADS
+        threads, and each of them is imported as soon as it is downloaded and
+        the previous ones are imported.
+
+        The transaction is committed every COMMIT_ROWS rows, along with a
+        checkpoint of the source in DATA_DIR. If the import of a source is
+        interrupted, the next run resumes it after its last checkpoint.
+        '''
+        pool = multiprocessing.pool.ThreadPool(
+            max(1, min(DOWNLOAD_THREADS, len(SOURCES))))
+
+        try:
+            downloads = self._prefetch(pool, options)
+            pool.close()
+
+            # modification times of the imported city sources
+            mtimes = []
+            for url in SOURCES:
+                geonames = downloads[url].get()
+                if self.source_import(url, geonames, options) and (
+                        url in CITY_SOURCES):
+                    mtimes.append(os.path.getmtime(geonames.file_path))
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        self.logger.info('Importing parsed translation in the database')
+        self.translation_import()
+
+        if mtimes:
+            # the changes of the day the oldest source was published may not
+            # be in it, --incremental starts with that day
+            transaction.commit()
+            self._write_incremental_date(datetime.datetime.utcfromtimestamp(
+                min(mtimes)).date() - datetime.timedelta(days=1))
+
+    def _prefetch(self, pool, options):
+        '''
+        Download and validate all SOURCES in pool, return a dict of url to
+        the AsyncResult of its Geonames instance.
+        '''
+        downloads = {}
+
         for url in SOURCES:
             destination_file_name = url.split('/')[-1]
 
@@ -108,64 +356,388 @@ It is possible to force the import of files which weren't downloaded using the
                     if f in destination_file_name or f in url:
                         force = True
 
-            geonames = Geonames(url, force=force)
-            downloaded = geonames.downloaded
+            downloads[url] = pool.apply_async(Geonames, (url,),
+                {'force': force})
 
-            force_import = options.get('force_import_all', False)
+        return downloads
 
-            if not force_import:
-                for f in options['force_import']:
-                    if f in destination_file_name or f in url:
-                        force_import = True
-
-            if downloaded or force_import:
-                self.logger.info('Importing %s' % destination_file_name)
-
-                if url in TRANSLATION_SOURCES:
-                    if options.get('hack_translations', False):
-                        if os.path.exists(translation_hack_path):
-                            self.logger.debug(
-                                'Using translation parsed data: %s' %
-                                translation_hack_path)
-                            continue
-
-                i = 0
-                progress = progressbar.ProgressBar(maxval=geonames.num_lines(),
-                    widgets=self.widgets)
-
-                for items in geonames.parse():
-                    if url in CITY_SOURCES:
-                        self.city_import(items)
-                    elif url in REGION_SOURCES:
-                        self.region_import(items)
-                    elif url in COUNTRY_SOURCES:
-                        self.country_import(items)
-                    elif url in TRANSLATION_SOURCES:
-                        # free some memory
-                        if getattr(self, '_country_codes', False):
-                            del self._country_codes
-                        if getattr(self, '_region_codes', False):
-                            del self._region_codes
-                        self.translation_parse(items)
+    def source_import(self, url, geonames, options):
+        '''
+        Import a downloaded source, if it was downloaded, if its import is
+        forced or if a checkpoint of it exists. Return True if it was
+        imported.
+        '''
+        destination_file_name = url.split('/')[-1]
+        downloaded = geonames.downloaded
+
+        force_import = options.get('force_import_all', False)
+
+        if not force_import:
+            for f in options['force_import']:
+                if f in destination_file_name or f in url:
+                    force_import = True
+
+        cache = None
+        if url in TRANSLATION_SOURCES and options.get(
+                'hack_translations', False):
+            cache = TranslationCache(os.path.join(DATA_DIR,
+                '%s.cache' % destination_file_name))
+            cache_key = TranslationCache.make_key(geonames.file_path,
+                TRANSLATION_LANGUAGES)
+
+            if cache.is_valid(cache_key):
+                self.logger.debug('Using translation cache: %s' %
+                    cache.path)
+                self.translation_caches.append(cache)
+                return
 
-                    reset_queries()
+            # the cache is stale, rebuild it
+            force_import = True
 
-                    i += 1
-                    progress.update(i)
+        checkpoint = self._read_checkpoint(geonames)
 
-                progress.finish()
+        if downloaded or force_import or checkpoint:
+            self.logger.info('Importing %s' % destination_file_name)
 
-                if url in TRANSLATION_SOURCES and options.get(
-                        'hack_translations', False):
-                    with open(translation_hack_path, 'w+') as f:
-                        pickle.dump(self.translation_data, f)
+            offset = 0
+            self._batch = 0
+            if checkpoint:
+                offset = checkpoint['offset']
+                self._batch = checkpoint['batch']
+                self.logger.info('Resuming after batch %s, at byte %s' %
+                    (self._batch, offset))
 
-        if options.get('hack_translations', False):
-            with open(translation_hack_path, 'r') as f:
-                self.translation_data = pickle.load(f)
+            rows = self._progress(geonames,
+                self._parse(url, geonames, offset))
+
+            self._resume_offset = None
+            if url in CITY_SOURCES:
+                batch_signal = city_items_batch_pre_import
+            elif url in REGION_SOURCES:
+                batch_signal = region_items_batch_pre_import
+            else:
+                batch_signal = None
+
+            if batch_signal is not None and batch_signal.receivers:
+                rows = self._send_batches(batch_signal, geonames, rows,
+                    offset)
+
+            for i, items in enumerate(rows, 1):
+                if url in CITY_SOURCES:
+                    self.city_import(items)
+                elif url in REGION_SOURCES:
+                    self.region_import(items)
+                elif url in COUNTRY_SOURCES:
+                    self.country_import(items)
+                elif url in TRANSLATION_SOURCES:
+                    # free some memory
+                    if getattr(self, '_country_codes', False):
+                        del self._country_codes
+                    if getattr(self, '_region_codes', False):
+                        del self._region_codes
+                    if getattr(self, '_city_ids', False):
+                        del self._city_ids
+                        del self._city_geoname_ids
+                        del self._complete_city_ids
+                    self.translation_parse(items)
+                    continue
+
+                reset_queries()
+
+                if not i % COMMIT_ROWS:
+                    self._commit(url, geonames)
+
+            if url in CITY_SOURCES:
+                self.city_flush()
+
+            transaction.commit()
+            self._clear_checkpoint(geonames)
+
+            if cache is not None:
+                self.logger.info('Writing translation cache: %s' %
+                    cache.path)
+                max, groups = self._translation_groups()
+                cache.write(groups, cache_key)
+                self._translation_reset()
+                self.translation_caches.append(cache)
+
+            return True
+
+        return False
+
+    def _commit(self, url, geonames):
+        '''
+        Commit the rows imported so far and checkpoint the source.
+        '''
+        if url in CITY_SOURCES:
+            self.city_flush()
+
+        transaction.commit()
+        self._batch += 1
+
+        offset = self._resume_offset
+        if offset is None:
+            offset = geonames.offset
+
+        with open(geonames.file_path + '.checkpoint', 'w') as f:
+            json.dump({
+                'offset': offset,
+                'batch': self._batch,
+                'size': os.path.getsize(geonames.file_path),
+                'mtime': os.path.getmtime(geonames.file_path),
+            }, f)
+
+    def _send_batches(self, signal, geonames, rows, offset=0):
+        '''
+        Send signal with batches of BATCH_SIZE rows, yield the rows its
+        receivers kept.
+
+        geonames.offset is past the whole batch while its rows are yielded,
+        so _resume_offset is set to the offset of its first row for
+        checkpoints.
+        '''
+        rows = iter(rows)
+        self._resume_offset = offset
+
+        while True:
+            batch = list(itertools.islice(rows, BATCH_SIZE))
+            if not batch:
+                break
+
+            end = geonames.offset
+            signal.send(sender=self, batch=batch)
+
+            for items in batch:
+                if items is not None:
+                    yield items
+
+            self._resume_offset = end
+
+        self._resume_offset = None
+
+    def _read_checkpoint(self, geonames):
+        '''
+        Return the checkpoint of a source if it was written for the current
+        version of the source file.
+        '''
+        path = geonames.file_path + '.checkpoint'
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r') as f:
+            checkpoint = json.load(f)
+
+        if (checkpoint['size'] != os.path.getsize(geonames.file_path) or
+                checkpoint['mtime'] != os.path.getmtime(geonames.file_path)):
+            self.logger.info('Ignoring outdated checkpoint %s' % path)
+            self._clear_checkpoint(geonames)
+            return None
+
+        return checkpoint
+
+    def _clear_checkpoint(self, geonames):
+        path = geonames.file_path + '.checkpoint'
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _progress(self, geonames, rows):
+        '''
+        Yield rows, showing the number of bytes of the source consumed in a
+        progress bar updated at most every progress_interval seconds.
+        '''
+        progress = None
+        updated = 0
+
+        for i, items in enumerate(rows):
+            yield items
+
+            if not i % 1000:
+                if progress is None:
+                    # the size is known once parsing started
+                    progress = progressbar.ProgressBar(
+                        maxval=max(geonames.size, 1), widgets=self.widgets)
+
+                now = time.time()
+                if now - updated > self.progress_interval:
+                    progress.update(min(geonames.position, progress.maxval))
+                    updated = now
+
+        if progress is not None:
+            progress.finish()
+
+    def _parse(self, url, geonames, offset=0):
+        '''
+        Return an iterator over the rows of a source after offset which pass
+        its row filter, parsed by processes of a pool for city and
+        translation sources if --parallel was used.
+        '''
+        if url in CITY_SOURCES:
+            columns, row_filter = CITY_COLUMNS, self.city_filter
+        elif url in REGION_SOURCES:
+            columns, row_filter = REGION_COLUMNS, self.region_filter
+        elif url in COUNTRY_SOURCES:
+            columns, row_filter = COUNTRY_COLUMNS, self.country_filter
+        else:
+            if not hasattr(self, '_translation_models'):
+                self._load_translation_models()
+                self._translation_reset()
+
+            columns = TRANSLATION_COLUMNS
+            row_filter = TranslationFilter(TRANSLATION_LANGUAGES,
+                self._translation_models)
+
+        if not self.parallel or not (url in CITY_SOURCES or
+                url in TRANSLATION_SOURCES):
+            return geonames.parse(offset, columns, row_filter)
+
+        return itertools.chain.from_iterable(geonames.parse_parallel(
+            self.parallel, row_filter, offset=offset, columns=columns))
+
+    def incremental_import(self, base_url=None, until=None):
+        '''
+        Apply the daily files of base_url for each day after the last one
+        applied, until the day before until. The last day applied is recorded
+        in DATA_DIR/incremental_date, which a full import of CITY_SOURCES also
+        sets.
+        '''
+        base_url = base_url or INCREMENTAL_SOURCE
+        until = until or datetime.datetime.utcnow().date()
+        state_path = os.path.join(DATA_DIR, 'incremental_date')
+
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as f:
+                day = datetime.datetime.strptime(f.read().strip(),
+                    '%Y-%m-%d').date()
+        else:
+            day = until - datetime.timedelta(days=2)
+            self.logger.warning('No import was recorded in %s, starting '
+                'after %s' % (state_path, day))
+
+        day += datetime.timedelta(days=1)
+        while day < until:
+            self.incremental_day(day, base_url)
+            transaction.commit()
+            self._write_incremental_date(day)
+
+            day += datetime.timedelta(days=1)
+
+    def _write_incremental_date(self, day):
+        '''
+        Record in DATA_DIR/incremental_date that the changes of day and of
+        the days before it are imported.
+        '''
+        with open(os.path.join(DATA_DIR, 'incremental_date'), 'w') as f:
+            f.write(day.strftime('%Y-%m-%d'))
+
+    def incremental_day(self, day, base_url):
+        '''
+        Download and apply the modifications and deletions of a day.
+
+        Deleted alternate names can not be applied because alternate_names
+        does not keep the id of each name, they are only logged.
+        '''
+        self.logger.info('Applying the changes of %s' % day)
+
+        for name in INCREMENTAL_FILES:
+            url = '%s%s-%s.txt' % (base_url, name, day.strftime('%Y-%m-%d'))
+            geonames = Geonames(url, force=True)
+
+            columns = None
+            if name == 'modifications':
+                columns = CITY_COLUMNS
+            elif name == 'alternateNamesModifications':
+                columns = TRANSLATION_COLUMNS
+
+            rows = self._progress(geonames, geonames.parse(columns=columns))
+            if name == 'modifications':
+                if city_items_batch_pre_import.receivers:
+                    rows = self._send_batches(city_items_batch_pre_import,
+                        geonames, rows)
+
+                for items in rows:
+                    self.city_modify(items)
+                    reset_queries()
+            elif name == 'deletes':
+                geoname_ids = [int(items[0]) for items in rows]
+                City.objects.filter(geoname_id__in=geoname_ids).delete()
+            elif name == 'alternateNamesModifications':
+                for items in rows:
+                    self.translation_parse(items)
+            else:
+                for items in rows:
+                    self.logger.debug('Ignoring deleted alternate name %s of'
+                        ' %s' % (items[0], items[1]))
+
+            os.remove(geonames.file_path)
+            os.remove(geonames.file_path + '.headers')
 
-        self.logger.info('Importing parsed translation in the database')
         self.translation_import()
+        self._translation_reset()
+
+    def city_modify(self, items):
+        '''
+        Apply a row of a modifications file: overwrite the names, coordinates,
+        country and region of an existing city, or insert a new city if it is
+        big enough for CITY_SOURCES and passes the city filter.
+        '''
+        try:
+            city = City.objects.get(geoname_id=items[0])
+        except City.DoesNotExist:
+            if self.noinsert:
+                return
+
+            if (items[14] or 0) < self._get_minimum_population() or (
+                    self.city_filter is not None and
+                    not self.city_filter(items)):
+                return
+
+            city = City(geoname_id=items[0])
+
+        try:
+            city_items_pre_import.send(sender=self, items=items)
+        except InvalidItems:
+            return
+
+        try:
+            city.country_id = self._get_country_id(items[8])
+        except Country.DoesNotExist:
+            self.logger.warning('Ignoring the modification of city %s: '
+                'country %s does not exist' % (items[0], items[8]))
+            return
+
+        city.name = items[1]
+        city.name_ascii = items[2]
+        city.latitude = items[4]
+        city.longitude = items[5]
+
+        if not TRANSLATION_SOURCES:
+            city.alternate_names = items[3]
+
+        try:
+            city.region_id = self._get_region_id(items[8], items[10])
+        except Region.DoesNotExist:
+            self.logger.warning('City %s has no region: region %s.%s does '
+                'not exist' % (items[0], items[8], items[10]))
+            city.region_id = None
+
+        city.save()
+
+    def _get_minimum_population(self):
+        '''
+        Return the population of the smallest cities of CITY_SOURCES, ie.
+        15000 for cities15000.zip, or 0 if any source has no such minimum.
+        '''
+        minimum = None
+        for url in CITY_SOURCES:
+            match = re.search(r'cities(\d+)', url.split('/')[-1])
+            if match is None:
+                return 0
+
+            population = int(match.group(1))
+            if minimum is None or population < minimum:
+                minimum = population
+
+        return minimum or 0
 
     def _get_country_id(self, code2):
         '''
@@ -204,7 +776,7 @@ It is possible to force the import of files which weren't downloaded using the
                 return
             country = Country(code2=items[0])
 
-        country.name = force_unicode(items[4])
+        country.name = items[4]
         country.code3 = items[1]
         country.continent = items[8]
         country.tld = items[9][1:]  # strip the leading dot
@@ -218,8 +790,6 @@ It is possible to force the import of files which weren't downloaded using the
         except InvalidItems:
             return
 
-        items = [force_unicode(x) for x in items]
-
         name = items[1]
         if not items[1]:
             name = items[2]
@@ -262,11 +832,64 @@ It is possible to force the import of files which weren't downloaded using the
         region.geoname_id = items[3]
         region.save()
 
+    def _load_city_ids(self):
+        '''
+        Identity map for (country_id, name)->city and geoname_id->city, loaded
+        with a single query.
+
+        The pks of cities which city_import() would not change anyway are
+        kept in _complete_city_ids, so that their rows are skipped without any
+        query.
+        '''
+        fields = ['geoname_id', 'region', 'latitude', 'longitude']
+        if not TRANSLATION_SOURCES:
+            fields.append('alternate_names')
+
+        self._city_attnames = [City._meta.get_field(f).attname
+            for f in fields]
+        self._city_ids = {}
+        self._city_geoname_ids = {}
+        self._complete_city_ids = set()
+
+        cities = City.objects.values_list('pk', 'country', 'name', *fields)
+        for row in cities.iterator():
+            self._add_city_id(row[0], row[1], row[2], row[3], all(row[3:]))
+
+    def _add_city_id(self, pk, country_id, name, geoname_id, complete):
+        '''
+        Add a city to the identity map loaded by _load_city_ids().
+        '''
+        self._city_ids.setdefault((country_id, name), pk)
+
+        if geoname_id:
+            self._city_geoname_ids[int(geoname_id)] = pk
+
+        if complete:
+            self._complete_city_ids.add(pk)
+
+    def _add_city(self, city):
+        self._add_city_id(city.pk, city.country_id, city.name,
+            city.geoname_id, all([getattr(city, attname)
+                for attname in self._city_attnames]))
+
+    def _get_city_id(self, country_id, name, geoname_id):
+        '''
+        Return the pk of the city matching a row and whether it matched by
+        geoname_id only, in which case it should be renamed.
+        '''
+        pk = self._city_ids.get((country_id, name), None)
+        if pk is not None:
+            return pk, False
+
+        pk = self._city_geoname_ids.get(int(geoname_id), None)
+        return pk, pk is not None
+
     def city_import(self, items):
-        try:
-            city_items_pre_import.send(sender=self, items=items)
-        except InvalidItems:
-            return
+        if self.send_city_items:
+            try:
+                city_items_pre_import.send(sender=self, items=items)
+            except InvalidItems:
+                return
 
         try:
             country_id = self._get_country_id(items[8])
@@ -276,28 +899,139 @@ It is possible to force the import of files which weren't downloaded using the
             else:
                 raise
 
-        try:
-            kwargs = dict(name=force_unicode(items[1]),
-                country_id=self._get_country_id(items[8]))
-        except Country.DoesNotExist:
+        if not hasattr(self, '_city_ids'):
+            self._load_city_ids()
+
+        name = items[1]
+        pk, rename = self._get_city_id(country_id, name, items[0])
+
+        if pk in self._complete_city_ids:
+            return
+
+        if self.bulk:
+            self._city_batch.append((country_id, items))
+            if len(self._city_batch) >= BATCH_SIZE:
+                self.city_flush()
+            return
+
+        if pk is None:
             if self.noinsert:
                 return
-            else:
-                raise
 
-        try:
-            city = City.objects.get(**kwargs)
-        except City.DoesNotExist:
-            try:
-                city = City.objects.get(geoname_id=items[0])
-                city.name = force_unicode(items[1])
-                city.country_id = self._get_country_id(items[8])
-            except City.DoesNotExist:
-                if self.noinsert:
-                    return
+            city = City(name=name, country_id=country_id)
+        else:
+            city = City.objects.get(pk=pk)
+
+            if rename:
+                city.name = name
+                city.country_id = country_id
 
-                city = City(**kwargs)
+        if self._city_update(city, items):
+            city.save()
+            self._add_city(city)
+
+    def city_flush(self):
+        """
+        Write the cities accumulated by city_import() in bulk mode.
+
+        Existing cities are fetched with a single query for the whole batch,
+        new cities are inserted with bulk_create() and changed cities are
+        updated with bulk_update(). As neither sends pre_save, it is sent here
+        for each written city so that denormalized fields are still set, once
+        the regions and countries of the batch are loaded, and the
+        CitySearchKeys of the batch are written with set_search_keys()
+        instead of post_save.
+        """
+        batch, self._city_batch = self._city_batch, []
+        if not batch:
+            return
 
+        pks = set()
+        for country_id, items in batch:
+            pk, rename = self._get_city_id(country_id, items[1], items[0])
+            if pk is not None:
+                pks.add(pk)
+        existing = City.objects.in_bulk(pks)
+
+        # cities added by this batch, by name and geoname_id
+        by_name = {}
+        by_geoname_id = {}
+
+        inserts = []
+        inserted = set()
+        updates = {}
+        for country_id, items in batch:
+            name = items[1]
+            geoname_id = items[0]
+
+            city = by_name.get((country_id, name), None)
+            if city is None:
+                pk, rename = self._get_city_id(country_id, name, geoname_id)
+                city = existing.get(pk, None)
+
+                if city is None:
+                    city = by_geoname_id.get(geoname_id, None)
+                    rename = city is not None
+
+                if rename:
+                    city.name = name
+                    city.country_id = country_id
+                elif city is None:
+                    if self.noinsert:
+                        continue
+                    city = City(name=name, country_id=country_id)
+
+            if not self._city_update(city, items):
+                continue
+
+            if city.pk:
+                updates[city.pk] = city
+            elif id(city) not in inserted:
+                # unsaved instances all compare equal, track them by identity
+                inserted.add(id(city))
+                inserts.append(city)
+                by_name[(country_id, name)] = city
+                by_geoname_id[geoname_id] = city
+
+        cities = inserts + updates.values()
+
+        # the pre_save receivers read the region and country of each city,
+        # load them with a query each for the whole batch
+        regions = Region.objects.in_bulk(set(city.region_id
+            for city in cities if city.region_id))
+        countries = Country.objects.in_bulk(set(city.country_id
+            for city in cities))
+        for city in cities:
+            if city.region_id in regions:
+                city.region = regions[city.region_id]
+            city.country = countries[city.country_id]
+
+        for city in cities:
+            signals.pre_save.send(sender=City, instance=city, raw=False,
+                using=City.objects.db)
+
+        City.objects.bulk_create(inserts)
+        bulk_update(City, updates.values(), [f.name for f in
+            City._meta.local_fields if not f.primary_key])
+
+        for city in updates.values():
+            self._add_city(city)
+
+        # bulk_create() does not set pks, fetch them for the identity map
+        created = City.objects.filter(geoname_id__in=[c.geoname_id
+            for c in inserts]).values_list('pk', 'geoname_id')
+        for pk, geoname_id in created:
+            city = by_geoname_id[geoname_id]
+            city.pk = pk
+            self._add_city(city)
+
+        if is_connected(signals.post_save, city_search_keys, City):
+            set_search_keys(cities)
+
+    def _city_update(self, city, items):
+        """
+        Set the fields of city from items, return True if it should be saved.
+        """
         save = False
         if not city.region_id:
             try:
@@ -320,7 +1054,7 @@ It is possible to force the import of files which weren't downloaded using the
             save = True
 
         if not TRANSLATION_SOURCES and not city.alternate_names:
-            city.alternate_names = force_unicode(items[3])
+            city.alternate_names = items[3]
             save = True
 
         if not city.geoname_id:
@@ -328,40 +1062,27 @@ It is possible to force the import of files which weren't downloaded using the
             city.geoname_id = items[0]
             save = True
 
-        if save:
-            city.save()
+        return save
 
     def translation_parse(self, items):
-        if not hasattr(self, 'translation_data'):
-            self.country_ids = Country.objects.values_list('geoname_id',
-                flat=True)
-            self.region_ids = Region.objects.values_list('geoname_id',
-                flat=True)
-            self.city_ids = City.objects.values_list('geoname_id', flat=True)
-
-            self.translation_data = {
-                Country: {},
-                Region: {},
-                City: {},
-            }
-
-        if len(items) > 4:
+        if not hasattr(self, '_translation_models'):
+            self._load_translation_models()
+            self._translation_reset()
+
+        if any(items[4:]):
             # avoid shortnames, colloquial, and historic
             return
 
         if items[2] not in TRANSLATION_LANGUAGES:
             return
 
-        # arg optimisation code kills me !!!
-        items[1] = int(items[1])
+        model_class = self._translation_models.get(items[1], None)
+        if model_class is None:
+            return
 
-        if items[1] in self.country_ids:
-            model_class = Country
-        elif items[1] in self.region_ids:
-            model_class = Region
-        elif items[1] in self.city_ids:
-            model_class = City
-        else:
+        if self.translation_spool is not None:
+            self.translation_spool.add(model_class.__name__, items[1],
+                items[2], items[3])
             return
 
         if items[1] not in self.translation_data[model_class]:
@@ -372,52 +1093,125 @@ It is possible to force the import of files which weren't downloaded using the
 
         self.translation_data[model_class][items[1]][items[2]].append(items[3])
 
-    def translation_import(self):
-        data = getattr(self, 'translation_data', None)
+    def _load_translation_models(self):
+        '''
+        Map the geoname_id of every country, region and city to its model
+        class, so that translation_parse() rejects or classifies a row with a
+        single dict lookup.
+        '''
+        self._translation_models = {}
 
-        if not data:
-            return
+        # countries take precedence over regions, which take precedence over
+        # cities
+        for model_class in (City, Region, Country):
+            geoname_ids = model_class.objects.exclude(geoname_id=None
+                ).values_list('geoname_id', flat=True)
+            self._translation_models.update(
+                dict.fromkeys(geoname_ids.iterator(), model_class))
+
+    def _translation_reset(self):
+        '''
+        Start a new aggregation of parsed translations, in translation_data
+        or in a TranslationSpool if TRANSLATION_MEMORY_BUDGET is set.
+        '''
+        spool = getattr(self, 'translation_spool', None)
+        if spool is not None:
+            spool.close()
+
+        self.translation_spool = None
+        self.translation_data = {
+            Country: {},
+            Region: {},
+            City: {},
+        }
+
+        if TRANSLATION_MEMORY_BUDGET:
+            self.translation_spool = TranslationSpool(
+                TRANSLATION_MEMORY_BUDGET)
+
+    def _translation_groups(self):
+        '''
+        Return the number of parsed translations and an iterator of
+        (model name, geoname_id, {lang: [names]}).
+        '''
+        spool = getattr(self, 'translation_spool', None)
+        if spool is not None:
+            return spool.count, iter(spool)
+
+        data = getattr(self, 'translation_data', None) or {}
 
         max = 0
-        for model_class, model_class_data in data.items():
-            max += len(model_class_data.keys())
+        for model_class_data in data.values():
+            for geoname_data in model_class_data.values():
+                max += sum(len(n) for n in geoname_data.values())
+
+        groups = ((model_class.__name__, geoname_id, geoname_data)
+            for model_class, model_class_data in data.items()
+            for geoname_id, geoname_data in model_class_data.items())
+
+        return max, groups
+
+    def translation_import(self):
+        model_classes = dict((m.__name__, m) for m in (Country, Region, City))
+
+        max, groups = self._translation_groups()
+        groups = [groups]
+        for cache in getattr(self, 'translation_caches', []):
+            max += cache.count
+            groups.append(iter(cache))
+
+        if not max:
+            return
 
         i = 0
         progress = progressbar.ProgressBar(maxval=max, widgets=self.widgets)
-        for model_class, model_class_data in data.items():
-            for geoname_id, geoname_data in model_class_data.items():
-                try:
-                    model = model_class.objects.get(geoname_id=geoname_id)
-                except model_class.DoesNotExist:
-                    continue
-                save = False
+        for j, group in enumerate(itertools.chain(*groups), 1):
+            model, geoname_id, geoname_data = group
+            self._translation_apply(model_classes[model], geoname_id,
+                geoname_data)
 
-                if not model.alternate_names:
-                    alternate_names = []
-                else:
-                    alternate_names = model.alternate_names.split(',')
+            i += sum(len(names) for names in geoname_data.values())
+            progress.update(i)
 
-                for lang, names in geoname_data.items():
-                    if lang == 'post':
-                        # we might want to save the postal codes somewhere
-                        # here's where it will all start ...
-                        continue
+            if not j % COMMIT_ROWS:
+                transaction.commit()
 
-                    for name in names:
-                        name = force_unicode(name)
-                        if name == model.name:
-                            continue
+        progress.finish()
 
-                        if name not in alternate_names:
-                            alternate_names.append(name)
+        spool = getattr(self, 'translation_spool', None)
+        if spool is not None:
+            spool.close()
 
-                alternate_names = u','.join(alternate_names)
-                if model.alternate_names != alternate_names:
-                    model.alternate_names = alternate_names
-                    save = True
+    def _translation_apply(self, model_class, geoname_id, geoname_data):
+        try:
+            model = model_class.objects.get(geoname_id=geoname_id)
+        except model_class.DoesNotExist:
+            return
+        save = False
 
-                if save:
-                    model.save()
+        if not model.alternate_names:
+            alternate_names = []
+        else:
+            alternate_names = model.alternate_names.split(',')
 
-                i += 1
-                progress.update(i)
+        for lang, names in geoname_data.items():
+            if lang == 'post':
+                # we might want to save the postal codes somewhere
+                # here's where it will all start ...
+                continue
+
+            for name in names:
+                name = force_unicode(name)
+                if name == model.name:
+                    continue
+
+                if name not in alternate_names:
+                    alternate_names.append(name)
+
+        alternate_names = u','.join(alternate_names)
+        if model.alternate_names != alternate_names:
+            model.alternate_names = alternate_names
+            save = True
+
+        if save:
+            model.save()
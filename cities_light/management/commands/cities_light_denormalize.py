@@ -0,0 +1,55 @@
+import logging
+import optparse
+
+import progressbar
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import Region, City
+from ...settings import BATCH_SIZE
+from ...denormalize import denormalize
+
+
+class Command(BaseCommand):
+    help = '''
+Set display_name, search_names, name_ascii and country of all regions and
+cities, by batches, like saving each of them would.
+
+Run it after an interrupted cities_light --defer-denormalization, or after
+changing countries, regions or cities with raw SQL or QuerySet.update():
+
+    manage.py cities_light_denormalize
+    '''.strip()
+
+    logger = logging.getLogger('cities_light')
+
+    option_list = BaseCommand.option_list + (
+        optparse.make_option('--batch-size', type='int', default=BATCH_SIZE,
+            help='Number of regions or cities to update per batch'
+        ),
+    )
+
+    @transaction.commit_manually
+    def handle(self, *args, **options):
+        maxval = Region.objects.count() + City.objects.count()
+        progress = progressbar.ProgressBar(maxval=max(maxval, 1),
+            widgets=[progressbar.ETA(), ' Done: ', progressbar.Percentage(),
+                progressbar.Bar()])
+
+        self.logger.info('Denormalizing %s regions and cities' % maxval)
+
+        try:
+            i = 0
+            for model, count in denormalize(options['batch_size']):
+                transaction.commit()
+
+                i += count
+                progress.update(i)
+        except:
+            transaction.rollback()
+            raise
+        else:
+            transaction.commit()
+
+        progress.finish()
@@ -0,0 +1,40 @@
+import logging
+import os
+import os.path
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...models import Country, Region, City
+from ...settings import SNAPSHOT_PATH
+from ...snapshot import write_snapshot
+
+
+class Command(BaseCommand):
+    args = '[path]'
+    help = '''
+Write all countries, regions and cities to a binary snapshot, which
+cities_light.snapshot.Snapshot memory-maps to look them up without the
+database. The default path is settings.CITIES_LIGHT_SNAPSHOT_PATH:
+
+    manage.py cities_light_snapshot [path]
+
+Run it again after each import: readers which opened the previous snapshot
+keep reading it until they open the new one.
+    '''.strip()
+
+    logger = logging.getLogger('cities_light')
+
+    def handle(self, *args, **options):
+        path = args[0] if args else SNAPSHOT_PATH
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        start = time.time()
+        write_snapshot(path, Country.objects.all(), Region.objects.all(),
+            City.objects.all())
+
+        self.logger.info('Wrote %s bytes to %s in %.1fs' % (
+            os.path.getsize(path), path, time.time() - start))
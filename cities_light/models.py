@@ -1,8 +1,11 @@
+import contextlib
 import unicodedata
 import re
+import math
+import operator
 
 from django.utils.encoding import force_unicode
-from django.db.models import signals
+from django.db.models import signals, Q
 from django.db import models
 from django.utils.translation import ugettext as _
 
@@ -11,12 +14,25 @@ from south.modelsinspector import add_introspection_rules
 import autoslug
 
 from settings import *
+from lru import lru_cache
+import geohash
 
-__all__ = ['Country', 'Region', 'City', 'CONTINENT_CHOICES', 'to_search',
-    'to_ascii']
+__all__ = ['Country', 'Region', 'City', 'CitySearchKey', 'CONTINENT_CHOICES',
+    'to_search', 'to_ascii', 'to_search_batch', 'to_ascii_batch']
 
 ALPHA_REGEXP = re.compile('[\W_]+', re.UNICODE)
 
+# what ALPHA_REGEXP removes from ascii strings, but the separator of
+# to_search_batch()
+NON_ALPHA_CHARACTERS = ''.join(c for c in map(chr, range(1, 128))
+    if not c.isalnum())
+
+# maximum length of CitySearchKey.key, which MySQL can still index
+SEARCH_KEY_MAX_LENGTH = 255
+
+# number of values of which to_search() keeps the result
+NORMALIZE_CACHE_SIZE = 10000
+
 CONTINENT_CHOICES = (
     ('OC', _(u'Oceania')),
     ('EU', _(u'Europe')),
@@ -35,6 +51,7 @@ def to_ascii(value):
     return unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
 
 
+@lru_cache(NORMALIZE_CACHE_SIZE)
 def to_search(value):
     """
     Convert a string value into a string that is usable against
@@ -46,6 +63,42 @@ def to_search(value):
     return ALPHA_REGEXP.sub('', to_ascii(value)).lower()
 
 
+def to_ascii_batch(values):
+    """
+    Return the list of to_ascii() of values, normalized in a single call.
+
+    Values are joined with NUL characters, which normalization keeps, and
+    split afterwards. Results are not memoized.
+    """
+    values = [force_unicode(value) if isinstance(value, str) else value
+        for value in values]
+
+    results = unicodedata.normalize('NFKD', u'\x00'.join(values)).encode(
+        'ascii', 'ignore').split('\x00')
+
+    if len(results) != len(values):
+        # some values contain NUL characters
+        return [to_ascii(value) for value in values]
+
+    return results
+
+
+def to_search_batch(values):
+    """
+    Return the list of to_search() of values, normalized in a single call
+    like to_ascii_batch().
+    """
+    values = list(values)
+    joined = '\x00'.join(to_ascii_batch(values))
+    results = joined.translate(None, NON_ALPHA_CHARACTERS).lower().split(
+        '\x00')
+
+    if len(results) != len(values):
+        return [to_search(value) for value in values]
+
+    return results
+
+
 def set_name_ascii(sender, instance=None, **kwargs):
     """
     Signal reciever that sets instance.name_ascii from instance.name.
@@ -150,6 +203,134 @@ class ToSearchTextField(models.TextField):
         return (field_class, args, kwargs)
 
 
+class CityQuerySet(models.query.QuerySet):
+    """
+    QuerySet for City, with search().
+    """
+
+    def search(self, query):
+        """
+        Return the cities of which a search key starts with to_search() of
+        query, using the index of CitySearchKey.key rather than scanning
+        City.search_names.
+
+        For example, 'Paris' and 'paris, fr' both match Paris, France.
+        """
+        key = to_search(query)[:SEARCH_KEY_MAX_LENGTH]
+        if not key:
+            return self._clone()
+
+        return self.filter(search_keys__key__startswith=key).distinct()
+
+    def in_bbox(self, south, west, north, east):
+        """
+        Return the cities within the bounding box, in degrees. If west is
+        greater than east, the box crosses the antimeridian.
+
+        The cities are found with a few range lookups on the geohash index
+        and then filtered on their exact coordinates.
+        """
+        conditions = []
+        for start, stop in geohash.bbox_ranges(south, west, north, east):
+            if stop is None:
+                conditions.append(Q(geohash__gte=start))
+            else:
+                conditions.append(Q(geohash__gte=start, geohash__lt=stop))
+
+        queryset = self.filter(latitude__gte=str(south),
+            latitude__lte=str(north))
+        if conditions:
+            queryset = queryset.filter(reduce(operator.or_, conditions))
+
+        if west <= east:
+            return queryset.filter(longitude__gte=str(west),
+                longitude__lte=str(east))
+        else:
+            return queryset.filter(Q(longitude__gte=str(west)) |
+                Q(longitude__lte=str(east)))
+
+    def within(self, latitude, longitude, kilometers):
+        """
+        Return the list of the cities at most the given distance away from
+        the given coordinates, nearest first, with their distance in
+        kilometers as a distance attribute.
+
+        The cities of the bounding box of the circle are selected with
+        in_bbox(), and those outside of the circle are filtered out in
+        python.
+        """
+        latitude = float(latitude)
+        longitude = float(longitude)
+        angle = math.degrees(kilometers / geohash.EARTH_RADIUS)
+
+        south = max(-90., latitude - angle)
+        north = min(90., latitude + angle)
+        if south == -90. or north == 90. or angle >= 90.:
+            # the circle contains a pole
+            west, east = -180., 180.
+        else:
+            delta = math.degrees(math.asin(min(1., math.sin(math.radians(
+                angle)) / math.cos(math.radians(latitude)))))
+            west = longitude - delta
+            east = longitude + delta
+            if delta >= 180.:
+                west, east = -180., 180.
+            elif west < -180.:
+                west += 360.
+            elif east > 180.:
+                east -= 360.
+
+        cities = []
+        for city in self.in_bbox(south, west, north, east):
+            city.distance = geohash.haversine(latitude, longitude,
+                city.latitude, city.longitude)
+            if city.distance <= kilometers:
+                cities.append(city)
+
+        cities.sort(key=lambda city: city.distance)
+        return cities
+
+
+class CityManager(models.Manager):
+    """
+    Manager for City, which returns CityQuerySets.
+    """
+
+    def get_query_set(self):
+        return CityQuerySet(self.model, using=self._db)
+
+    def search(self, query):
+        return self.get_query_set().search(query)
+
+    def in_bbox(self, south, west, north, east):
+        return self.get_query_set().in_bbox(south, west, north, east)
+
+    def within(self, latitude, longitude, kilometers):
+        return self.get_query_set().within(latitude, longitude, kilometers)
+
+    def nearest(self, latitude, longitude, k=1):
+        """
+        Return the list of the k cities nearest to the given coordinates,
+        nearest first, with their distance in kilometers as a distance
+        attribute.
+
+        Cities are found in the index of cities_light.spatial, which requires
+        numpy, and loaded with a single query.
+        """
+        from .spatial import nearest
+
+        results = nearest(latitude, longitude, k)
+        cities = self.get_query_set().in_bulk([pk for pk, d in results])
+
+        nearest_cities = []
+        for pk, distance in results:
+            if pk in cities:
+                cities[pk].distance = distance
+                nearest_cities.append(cities[pk])
+
+        return nearest_cities
+
+
 class City(Base):
     """
     City model.
@@ -165,10 +346,14 @@ class City(Base):
         null=True, blank=True)
     longitude = models.DecimalField(max_digits=8, decimal_places=5,
         null=True, blank=True)
+    geohash = models.CharField(max_length=geohash.PRECISION, blank=True,
+        db_index=True)
 
     region = models.ForeignKey(Region, blank=True, null=True)
     country = models.ForeignKey(Country)
 
+    objects = CityManager()
+
     class Meta:
         unique_together = (('region', 'name'),)
         verbose_name_plural = _(u'cities')
@@ -183,39 +368,195 @@ signals.pre_save.connect(set_name_ascii, sender=City)
 signals.pre_save.connect(set_display_name, sender=City)
 
 
+def city_geohash(sender, instance, **kwargs):
+    """
+    Set instance.geohash from instance.latitude and instance.longitude.
+    """
+    if instance.latitude is None or instance.longitude is None:
+        instance.geohash = ''
+    else:
+        instance.geohash = geohash.encode(instance.latitude,
+            instance.longitude)
+signals.pre_save.connect(city_geohash, sender=City)
+
+
 def city_country(sender, instance, **kwargs):
     if instance.region_id and not instance.country_id:
         instance.country = instance.region.country
 signals.pre_save.connect(city_country, sender=City)
 
 
-def city_search_names(sender, instance, **kwargs):
-    search_names = []
+# to_search() of the names of countries and regions, by (model name, pk),
+# while cache_search_names() is active, so that saving a city does not query
+# its country and region nor normalize their names again
+_search_names_cache = None
+
+
+@contextlib.contextmanager
+def cache_search_names():
+    """
+    Context manager caching the normalized names of the countries and regions
+    of the cities saved within it, which the cities_light command uses for
+    the duration of an import. Cached names are dropped on exit, and when
+    their country or region is saved or deleted in the process.
+    """
+    global _search_names_cache
+
+    if _search_names_cache is not None:
+        # already caching
+        yield
+        return
 
-    country_names = [instance.country.name]
-    if instance.country.alternate_names:
-        country_names += instance.country.alternate_names.split(',')
+    _search_names_cache = {}
+    try:
+        yield
+    finally:
+        _search_names_cache = None
 
-    city_names = [instance.name]
+
+def get_names(instance):
+    """
+    Return the name and alternate names of instance.
+    """
+    names = [instance.name]
     if instance.alternate_names:
-        city_names += instance.alternate_names.split(',')
+        names += instance.alternate_names.split(',')
+
+    return names
+
+
+def get_search_names(instance):
+    """
+    Return the to_search() of the name and alternate names of instance.
+    """
+    return to_search_batch(get_names(instance))
+
+
+def get_related_search_names(instance, field):
+    """
+    Return get_search_names() of the country or region of a city, cached
+    if cache_search_names() is active.
+    """
+    cache = _search_names_cache
+    if cache is None:
+        return get_search_names(getattr(instance, field))
+
+    pk = getattr(instance, field + '_id')
+    names = cache.get((field, pk), None)
+
+    if names is None:
+        names = get_search_names(getattr(instance, field))
+        if pk is not None:
+            cache[(field, pk)] = names
+
+    return names
+
+
+def clear_search_names_cache(sender, instance, **kwargs):
+    if _search_names_cache is not None:
+        _search_names_cache.pop((sender._meta.module_name, instance.pk),
+            None)
+signals.post_save.connect(clear_search_names_cache, sender=Country)
+signals.post_delete.connect(clear_search_names_cache, sender=Country)
+signals.post_save.connect(clear_search_names_cache, sender=Region)
+signals.post_delete.connect(clear_search_names_cache, sender=Region)
 
-    if instance.region_id:
-        region_names = [instance.region.name]
-        if instance.region.alternate_names:
-            region_names += instance.region.alternate_names.split(',')
+
+def build_search_names(city_names, region_names, country_names):
+    """
+    Return the search_names of a city from get_search_names() of the city, of
+    its region (an empty list if it has none) and of its country.
+
+    As to_search() of a concatenation is the concatenation of to_search(),
+    names are only normalized once.
+    """
+    search_names = []
+    seen = set()
 
     for city_name in city_names:
         for country_name in country_names:
-            name = to_search(city_name + country_name)
-            if name not in search_names:
-                search_names.append(name)
+            names = [city_name + country_name]
+            names += [city_name + region_name + country_name
+                for region_name in region_names]
+
+            for name in names:
+                if name not in seen:
+                    seen.add(name)
+                    search_names.append(name)
+
+    return ' '.join(search_names)
 
-            if instance.region_id:
-                for region_name in region_names:
-                    name = to_search(city_name + region_name + country_name)
-                    if name not in search_names:
-                        search_names.append(name)
 
-    instance.search_names = ' '.join(search_names)
+def city_search_names(sender, instance, **kwargs):
+    region_names = []
+    if instance.region_id:
+        region_names = get_related_search_names(instance, 'region')
+
+    instance.search_names = build_search_names(get_search_names(instance),
+        region_names, get_related_search_names(instance, 'country'))
 signals.pre_save.connect(city_search_names, sender=City)
+
+
+class CitySearchKey(models.Model):
+    """
+    One of the search_names of a city, in a table of its own so that
+    City.objects.search() can use an index on it.
+    """
+
+    city = models.ForeignKey(City, related_name='search_keys')
+    key = models.CharField(max_length=SEARCH_KEY_MAX_LENGTH, db_index=True)
+
+    def __unicode__(self):
+        return self.key
+
+
+def get_search_keys(search_names):
+    """
+    Return the distinct keys of search_names, as CitySearchKey stores them.
+    """
+    keys = []
+    seen = set()
+    for name in search_names.split():
+        key = name[:SEARCH_KEY_MAX_LENGTH]
+        if key not in seen:
+            seen.add(key)
+            keys.append(key)
+
+    return keys
+
+
+def set_search_keys(cities, batch_size=BATCH_SIZE):
+    """
+    Make the CitySearchKeys of the saved cities match their search_names,
+    with a query to read the existing keys and a few queries to delete the
+    outdated ones and insert the missing ones.
+    """
+    cities = [city for city in cities if city.pk]
+    if not cities:
+        return
+
+    existing = {}
+    for start in range(0, len(cities), batch_size):
+        pks = [city.pk for city in cities[start:start + batch_size]]
+        for pk, city_id, key in CitySearchKey.objects.filter(
+                city__in=pks).values_list('pk', 'city_id', 'key'):
+            existing[(city_id, key)] = pk
+
+    missing = []
+    for city in cities:
+        for key in get_search_keys(city.search_names):
+            if existing.pop((city.pk, key), None) is None:
+                missing.append(CitySearchKey(city_id=city.pk, key=key))
+
+    # what remains in existing is outdated
+    outdated = existing.values()
+    for start in range(0, len(outdated), batch_size):
+        CitySearchKey.objects.filter(
+            pk__in=outdated[start:start + batch_size]).delete()
+
+    CitySearchKey.objects.bulk_create(missing)
+
+
+def city_search_keys(sender, instance, **kwargs):
+    set_search_keys([instance])
+signals.post_save.connect(city_search_keys, sender=City)
@@ -0,0 +1,143 @@
+"""
+In-process prefix index of countries, regions and cities, to answer
+autocomplete requests without searching the database.
+
+An index is a sorted list of the to_search() of the names and alternate
+names of a model, with the pk of the instance each key is from: the keys
+starting with a prefix are contiguous, bisect finds the first one and the
+following ones are read until k distinct pks are found. City keys are the
+keys of CitySearchKey, so search(City, query) finds the same cities as
+City.objects.search(query).
+
+Indexes are built from the database the first time they are needed in a
+process, dropped when the process saves or deletes an instance of their
+model, and built again after PREFIX_INDEX_TIMEOUT seconds to see changes
+made by other processes.
+"""
+
+import array
+import bisect
+import threading
+import time
+
+from django.db.models import signals
+
+from .models import (Country, Region, City, get_search_keys, to_search,
+    to_search_batch)
+from .settings import PREFIX_INDEX_TIMEOUT
+
+__all__ = ['PrefixIndex', 'get_index', 'search', 'in_order']
+
+
+class PrefixIndex(object):
+    """
+    Sorted (key, pk) pairs, searched by prefix with bisect.
+    """
+
+    def __init__(self, pairs):
+        pairs = sorted(set(pairs))
+        self.keys = [key for key, pk in pairs]
+        self.pks = array.array('l', [pk for key, pk in pairs])
+        self.created = time.time()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def expired(self, timeout=PREFIX_INDEX_TIMEOUT):
+        return timeout is not None and time.time() - self.created > timeout
+
+    def search(self, query, limit=None):
+        """
+        Return the pks of which a key starts with to_search() of query, at
+        most limit, by order of their first matching key: a key equal to the
+        prefix comes before the keys it is a prefix of.
+        """
+        prefix = to_search(query)
+        if not prefix:
+            return []
+
+        keys = self.keys
+        pks = []
+        seen = set()
+
+        i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            pk = self.pks[i]
+            if pk not in seen:
+                seen.add(pk)
+                pks.append(pk)
+
+                if len(pks) == limit:
+                    break
+            i += 1
+
+        return pks
+
+
+def get_pairs(model):
+    """
+    Yield the (key, pk) pairs of all instances of model, reading only the
+    columns the keys are made of.
+    """
+    if model is City:
+        rows = City.objects.values_list('pk', 'search_names').iterator()
+        for pk, search_names in rows:
+            for key in get_search_keys(search_names):
+                yield key, pk
+        return
+
+    rows = model.objects.values_list('pk', 'name', 'alternate_names')
+    for pk, name, alternate_names in rows.iterator():
+        names = [name]
+        if alternate_names:
+            names += alternate_names.split(',')
+
+        for key in to_search_batch(names):
+            if key:
+                yield key, pk
+
+
+# PrefixIndex by model, built by get_index()
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index(model):
+    """
+    Return the PrefixIndex of model, building it if the process does not
+    have it yet or if it expired.
+    """
+    index = _indexes.get(model, None)
+
+    if index is None or index.expired():
+        with _lock:
+            # another thread may have built it while this one waited
+            index = _indexes.get(model, None)
+            if index is None or index.expired():
+                index = _indexes[model] = PrefixIndex(get_pairs(model))
+
+    return index
+
+
+def search(model, query, limit=None):
+    """
+    Return the pks of at most limit instances of model matching query.
+    """
+    return get_index(model).search(query, limit)
+
+
+def in_order(queryset, pks):
+    """
+    Return the instances of queryset with the given pks, in the same order,
+    with a single query.
+    """
+    instances = queryset.in_bulk(pks)
+    return [instances[pk] for pk in pks if pk in instances]
+
+
+def clear_index(sender, **kwargs):
+    _indexes.pop(sender, None)
+
+for model in (Country, Region, City):
+    signals.post_save.connect(clear_index, sender=model)
+    signals.post_delete.connect(clear_index, sender=model)
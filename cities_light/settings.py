@@ -33,8 +33,17 @@ TRANSLATION_SOURCES
     alternateNames.zip from geonames download server. Overridable in
     settings.CITIES_LIGHT_TRANSLATION_SOURCES
 
+INCREMENTAL_SOURCE
+    Base url of the daily modifications-YYYY-MM-DD.txt, deletes-*.txt,
+    alternateNamesModifications-*.txt and alternateNamesDeletes-*.txt files
+    used by cities_light --incremental. Default is the geonames download
+    server, a file:// url to a local directory works too. Overridable in
+    settings.CITIES_LIGHT_INCREMENTAL_SOURCE
+
 SOURCES
-    A list with all sources.
+    A list with all sources. Sources may be plain text files or .zip, .gz or
+    .xz archives, which are read without being extracted. Reading .xz
+    archives requires backports.lzma.
 
 DATA_DIR
     Absolute path to download and extract data into. Default is
@@ -44,6 +53,80 @@ INDEX_SEARCH_NAMES
     If your database engine for cities_light supports indexing TextFields (ie.
     it is **not** MySQL), then this should be set to True. You might have to
     override this setting if using several databases for your project.
+
+BATCH_SIZE
+    Number of rows the cities_light command accumulates before writing them
+    when it runs with --bulk. Default is 500, which keeps the number of query
+    parameters under SQLite's limit. Overridable in
+    settings.CITIES_LIGHT_BATCH_SIZE
+
+COMMIT_ROWS
+    Number of rows after which the cities_light command commits the
+    transaction and records a checkpoint to resume from in DATA_DIR. Default
+    is 10000. Overridable in settings.CITIES_LIGHT_COMMIT_ROWS
+
+TRANSLATION_MEMORY_BUDGET
+    Approximate number of bytes of parsed alternate names the cities_light
+    command may hold in memory. Past this budget, they are spilled to sorted
+    temporary files which are merged when importing. Default is None, which
+    keeps everything in memory. Overridable in
+    settings.CITIES_LIGHT_TRANSLATION_MEMORY_BUDGET
+
+DOWNLOAD_THREADS
+    Number of SOURCES the cities_light command downloads at the same time,
+    while it imports the sources which are already downloaded. Default is 4.
+    Overridable in settings.CITIES_LIGHT_DOWNLOAD_THREADS
+
+INCLUDE_COUNTRIES
+    List of country codes to import, along with their regions and cities.
+    Default is None, which imports all countries. Overridable in
+    settings.CITIES_LIGHT_INCLUDE_COUNTRIES
+
+EXCLUDE_COUNTRIES
+    List of country codes not to import. Default is empty. Overridable in
+    settings.CITIES_LIGHT_EXCLUDE_COUNTRIES
+
+INCLUDE_CITY_TYPES
+    List of geonames feature codes of the cities to import, ie. ['PPLC',
+    'PPLA']. Default is None, which imports any kind of populated place.
+    Overridable in settings.CITIES_LIGHT_INCLUDE_CITY_TYPES
+
+EXCLUDE_CITY_TYPES
+    List of geonames feature codes of the cities not to import, ie.
+    ['PPLX', 'PPLH']. Default is empty. Overridable in
+    settings.CITIES_LIGHT_EXCLUDE_CITY_TYPES
+
+MINIMUM_POPULATION
+    Cities with a smaller population are not imported. Default is 0.
+    Overridable in settings.CITIES_LIGHT_MINIMUM_POPULATION
+
+These filters are checked on each line of the data files as they are parsed,
+which is much faster than raising InvalidItems from a receiver of
+city_items_pre_import.
+
+PREFIX_INDEX
+    If True, the lookups of cities_light.contrib find countries, regions and
+    cities in the in-process index of cities_light.prefix_index instead of
+    searching the database. Default is False. Overridable in
+    settings.CITIES_LIGHT_PREFIX_INDEX
+
+PREFIX_INDEX_TIMEOUT
+    Number of seconds after which an index of cities_light.prefix_index is
+    built again from the database, to see changes made by other processes
+    like the daily import. Default is 3600, None keeps indexes until the
+    process saves or deletes an instance of their model. Overridable in
+    settings.CITIES_LIGHT_PREFIX_INDEX_TIMEOUT
+
+SPATIAL_INDEX_TIMEOUT
+    Number of seconds after which the index of cities_light.spatial, used by
+    City.objects.nearest(), is built again from the database. Default is
+    3600, None keeps it until the process saves or deletes a city.
+    Overridable in settings.CITIES_LIGHT_SPATIAL_INDEX_TIMEOUT
+
+SNAPSHOT_PATH
+    Path of the snapshot written by the cities_light_snapshot command and
+    read by cities_light.snapshot.Snapshot. Default is DATA_DIR/snapshot.bin.
+    Overridable in settings.CITIES_LIGHT_SNAPSHOT_PATH
 """
 
 import os.path
@@ -52,7 +135,12 @@ from django.conf import settings
 
 __all__ = ['COUNTRY_SOURCES', 'REGION_SOURCES', 'CITY_SOURCES',
     'TRANSLATION_LANGUAGES', 'TRANSLATION_SOURCES', 'SOURCES', 'DATA_DIR',
-    'INDEX_SEARCH_NAMES', ]
+    'INDEX_SEARCH_NAMES', 'BATCH_SIZE', 'COMMIT_ROWS',
+    'TRANSLATION_MEMORY_BUDGET', 'DOWNLOAD_THREADS',
+    'INCLUDE_COUNTRIES', 'EXCLUDE_COUNTRIES', 'INCLUDE_CITY_TYPES',
+    'EXCLUDE_CITY_TYPES', 'MINIMUM_POPULATION', 'PREFIX_INDEX',
+    'PREFIX_INDEX_TIMEOUT', 'SPATIAL_INDEX_TIMEOUT', 'SNAPSHOT_PATH',
+    'INCREMENTAL_SOURCE', 'INCREMENTAL_FILES', ]
 
 COUNTRY_SOURCES = getattr(settings, 'CITIES_LIGHT_COUNTRY_SOURCES',
     ['http://download.geonames.org/export/dump/countryInfo.txt'])
@@ -65,6 +153,11 @@ TRANSLATION_SOURCES = getattr(settings, 'CITIES_LIGHT_TRANSLATION_SOURCES',
 TRANSLATION_LANGUAGES = getattr(settings, 'CITIES_LIGHT_TRANSLATION_LANGUAGES',
     ['es', 'en', 'pt', 'de', 'pl', 'abbr'])
 
+INCREMENTAL_SOURCE = getattr(settings, 'CITIES_LIGHT_INCREMENTAL_SOURCE',
+    'http://download.geonames.org/export/dump/')
+INCREMENTAL_FILES = ['modifications', 'deletes',
+    'alternateNamesModifications', 'alternateNamesDeletes']
+
 SOURCES = list(COUNTRY_SOURCES) + list(REGION_SOURCES) + list(CITY_SOURCES)
 SOURCES += TRANSLATION_SOURCES
 
@@ -79,3 +172,29 @@ if INDEX_SEARCH_NAMES is None:
     for database in settings.DATABASES.values():
         if 'mysql' in database['ENGINE'].lower():
             INDEX_SEARCH_NAMES = False
+
+BATCH_SIZE = getattr(settings, 'CITIES_LIGHT_BATCH_SIZE', 500)
+
+COMMIT_ROWS = getattr(settings, 'CITIES_LIGHT_COMMIT_ROWS', 10000)
+
+TRANSLATION_MEMORY_BUDGET = getattr(settings,
+    'CITIES_LIGHT_TRANSLATION_MEMORY_BUDGET', None)
+
+DOWNLOAD_THREADS = getattr(settings, 'CITIES_LIGHT_DOWNLOAD_THREADS', 4)
+
+INCLUDE_COUNTRIES = getattr(settings, 'CITIES_LIGHT_INCLUDE_COUNTRIES', None)
+EXCLUDE_COUNTRIES = getattr(settings, 'CITIES_LIGHT_EXCLUDE_COUNTRIES', [])
+INCLUDE_CITY_TYPES = getattr(settings, 'CITIES_LIGHT_INCLUDE_CITY_TYPES',
+    None)
+EXCLUDE_CITY_TYPES = getattr(settings, 'CITIES_LIGHT_EXCLUDE_CITY_TYPES', [])
+MINIMUM_POPULATION = getattr(settings, 'CITIES_LIGHT_MINIMUM_POPULATION', 0)
+
+PREFIX_INDEX = getattr(settings, 'CITIES_LIGHT_PREFIX_INDEX', False)
+PREFIX_INDEX_TIMEOUT = getattr(settings, 'CITIES_LIGHT_PREFIX_INDEX_TIMEOUT',
+    3600)
+
+SPATIAL_INDEX_TIMEOUT = getattr(settings,
+    'CITIES_LIGHT_SPATIAL_INDEX_TIMEOUT', 3600)
+
+SNAPSHOT_PATH = getattr(settings, 'CITIES_LIGHT_SNAPSHOT_PATH',
+    os.path.join(DATA_DIR, 'snapshot.bin'))
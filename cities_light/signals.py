@@ -17,11 +17,17 @@ city_items_pre_import
 
         cities_light.signals.city_items_pre_import.connect(filter_city_import)
 
+    Though such filters on countries, feature codes or population are much
+    faster with the CITIES_LIGHT_INCLUDE_COUNTRIES, ..._CITY_TYPES and
+    ..._MINIMUM_POPULATION settings, which are checked while parsing.
+
     Note: this signal gets a list rather than a City instance for performance
-    reasons.
+    reasons. Only the columns used by the cities_light command are parsed:
+    see CITY_COLUMNS in cities_light.geonames for their indexes and types,
+    other items are None.
 
 region_items_pre_import
-    Same as city_items_pre_import, for example::
+    Same as city_items_pre_import, with REGION_COLUMNS, for example::
 
         def filter_region_import(sender, items, **kwargs):
             if items[0].split('.')[0] not in ('FR', 'US', 'BE'):
@@ -29,10 +35,30 @@ region_items_pre_import
         cities_light.signals.region_items_pre_import.connect(
             filter_region_import)
 
+city_items_batch_pre_import
+    Emited by the cities_light command with a list of up to
+    CITIES_LIGHT_BATCH_SIZE city rows, before city_items_pre_import is sent
+    for each of them. Receivers may change the rows in place, remove them
+    from the list or replace them with None to skip them, which costs one
+    call per batch instead of one per row::
+
+        def filter_city_batch(sender, batch, **kwargs):
+            batch[:] = [items for items in batch if items[14] > 50000]
+
+        cities_light.signals.city_items_batch_pre_import.connect(
+            filter_city_batch)
+
+    It is only sent if it has receivers.
+
+region_items_batch_pre_import
+    Same as city_items_batch_pre_import, for region rows.
+
 filter_non_cities()
     By default, this reciever is connected to city_items_pre_import, it raises
     InvalidItems if the row doesn't have PPL in its features (it's not a
-    populated place).
+    populated place). The cities_light command does the same check while
+    parsing as long as it is connected, and does not send
+    city_items_pre_import at all if it is its only receiver.
 """
 
 import django.dispatch
@@ -40,10 +66,31 @@ import django.dispatch
 from exceptions import *
 
 __all__ = ['city_items_pre_import', 'region_items_pre_import',
+    'city_items_batch_pre_import', 'region_items_batch_pre_import',
     'filter_non_cities']
 
 city_items_pre_import = django.dispatch.Signal(providing_args=['items'])
 region_items_pre_import = django.dispatch.Signal(providing_args=['items'])
+city_items_batch_pre_import = django.dispatch.Signal(
+    providing_args=['batch'])
+region_items_batch_pre_import = django.dispatch.Signal(
+    providing_args=['batch'])
+
+
+def is_connected(signal, receiver, sender=None):
+    """
+    Return True if receiver is connected to signal for sender, or for any
+    sender if sender is None.
+    """
+    return any(key[0] == id(receiver) and (sender is None or
+        key[1] == id(sender)) for key, ref in signal.receivers)
+
+
+def has_other_receivers(signal, receiver):
+    """
+    Return True if signal has a receiver other than receiver.
+    """
+    return any(key[0] != id(receiver) for key, ref in signal.receivers)
 
 
 def filter_non_cities(sender, items, **kwargs):
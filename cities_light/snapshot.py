@@ -0,0 +1,348 @@
+"""
+Read-only binary snapshot of countries, regions and cities, memory-mapped
+to look them up without the database.
+
+The cities_light_snapshot command writes it with write_snapshot(), and
+Snapshot reads it::
+
+    snapshot = Snapshot(SNAPSHOT_PATH)
+    snapshot.countries.by_code('FR').name
+    snapshot.regions.by_code('FR.11').display_name
+    snapshot.cities.by_geoname_id(2988507).latitude
+    snapshot.cities.get(pk)
+
+The file holds a header, then sections of fixed size records packed with
+struct: one per model, sorted by pk, and indexes of (key, record number)
+sorted by key, searched by bisection. Strings are (offset, length) of utf-8
+bytes in a string table shared by all sections, where equal strings are
+stored once. Records are unpacked when they are looked up: opening a
+snapshot only reads its header, and processes which map the same file
+share its pages.
+
+Records are namedtuples of the fields of the models, where foreign keys,
+geoname_id and coordinates may be None, and other strings may be empty.
+"""
+
+import collections
+import mmap
+import os
+import struct
+import tempfile
+
+__all__ = ['Snapshot', 'write_snapshot', 'CountryRecord', 'RegionRecord',
+    'CityRecord']
+
+MAGIC = 'CLSNAP01'
+
+# sections, in the order of the header and of the file
+SECTIONS = ('countries', 'regions', 'cities', 'country_geoname_ids',
+    'region_geoname_ids', 'city_geoname_ids', 'country_codes',
+    'region_codes', 'strings')
+
+# magic, then (offset, number of items) of each section
+HEADER = struct.Struct('<8s' + 'QQ' * len(SECTIONS))
+
+# a string is the (offset, length) of its bytes in the string table
+STRING = 'II'
+
+# name, struct of the numeric fields, string fields of each model
+COUNTRY_FIELDS = (('id', 'geoname_id'), 'ii', ('name', 'name_ascii', 'slug',
+    'code2', 'code3', 'continent', 'tld', 'alternate_names'))
+REGION_FIELDS = (('id', 'geoname_id', 'country_id'), 'iii', ('name',
+    'name_ascii', 'slug', 'display_name', 'geoname_code', 'alternate_names'))
+CITY_FIELDS = (('id', 'geoname_id', 'region_id', 'country_id', 'latitude',
+    'longitude'), 'iiiidd', ('name', 'name_ascii', 'slug', 'display_name',
+    'alternate_names', 'geohash'))
+
+# (key, record number) of integer and string indexes
+INTEGER_KEY = struct.Struct('<ii')
+STRING_KEY = struct.Struct('<' + STRING + 'i')
+
+CountryRecord = collections.namedtuple('CountryRecord',
+    COUNTRY_FIELDS[0] + COUNTRY_FIELDS[2])
+RegionRecord = collections.namedtuple('RegionRecord',
+    REGION_FIELDS[0] + REGION_FIELDS[2])
+CityRecord = collections.namedtuple('CityRecord',
+    CITY_FIELDS[0] + CITY_FIELDS[2])
+
+
+def record_struct(fields):
+    numbers, format, strings = fields
+    return struct.Struct('<' + format + STRING * len(strings))
+
+
+class StringTable(object):
+    """
+    Strings added to a snapshot, each stored once.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.refs = {}
+
+    def add(self, value):
+        """
+        Return the (offset, length) of value in the table.
+        """
+        value = value or ''
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        ref = self.refs.get(value, None)
+
+        if ref is None:
+            ref = self.refs[value] = (self.size, len(value))
+            self.chunks.append(value)
+            self.size += len(value)
+
+        return ref
+
+
+def _pack_records(rows, fields, strings):
+    """
+    Return the bytes of the records of rows, which are tuples of the numeric
+    fields followed by the string fields.
+    """
+    packer = record_struct(fields)
+    count = len(fields[0])
+    packed = []
+
+    for row in rows:
+        values = []
+        for field, value in zip(fields[0], row[:count]):
+            if value is None:
+                # no foreign key or geoname_id is 0, no coordinates is nan
+                value = float('nan') if field in ('latitude',
+                    'longitude') else 0
+            values.append(float(value) if field in ('latitude',
+                'longitude') else value)
+
+        for value in row[count:]:
+            values.extend(strings.add(value))
+
+        packed.append(packer.pack(*values))
+
+    return ''.join(packed)
+
+
+def _pack_integer_index(pairs):
+    return ''.join(INTEGER_KEY.pack(key, number)
+        for key, number in sorted(pairs))
+
+
+def _pack_string_index(pairs, strings):
+    # sorted like the reader compares them, by utf-8 bytes
+    pairs = sorted((key.encode('utf-8'), number) for key, number in pairs)
+    return ''.join(STRING_KEY.pack(*(strings.add(key) + (number, )))
+        for key, number in pairs)
+
+
+def write_snapshot(path, countries, regions, cities):
+    """
+    Write the snapshot of the given querysets of countries, regions and
+    cities to path.
+
+    The file is written next to path and renamed over it, so that processes
+    which mapped the previous snapshot keep reading it.
+    """
+    strings = StringTable()
+    sections = {}
+
+    for name, queryset, fields, index in (
+            ('countries', countries, COUNTRY_FIELDS, 'country_geoname_ids'),
+            ('regions', regions, REGION_FIELDS, 'region_geoname_ids'),
+            ('cities', cities, CITY_FIELDS, 'city_geoname_ids')):
+        rows = list(queryset.order_by('pk').values_list(
+            *(fields[0] + fields[2])).iterator())
+        sections[name] = (_pack_records(rows, fields, strings), len(rows))
+
+        geoname_ids = [(row[1], number) for number, row in enumerate(rows)
+            if row[1] is not None]
+        sections[index] = (_pack_integer_index(geoname_ids),
+            len(geoname_ids))
+
+        if name == 'countries':
+            codes = [(code, number) for number, row in enumerate(rows)
+                for code in (row[5], row[6]) if code]
+            sections['country_codes'] = (_pack_string_index(codes, strings),
+                len(codes))
+            country_codes = dict((row[0], row[5]) for row in rows)
+        elif name == 'regions':
+            # regions are identified by country code and geoname code, like
+            # in admin1CodesASCII.txt
+            codes = [('%s.%s' % (country_codes.get(row[2]), row[7]), number)
+                for number, row in enumerate(rows)
+                if row[7] and country_codes.get(row[2])]
+            sections['region_codes'] = (_pack_string_index(codes, strings),
+                len(codes))
+
+    sections['strings'] = (''.join(strings.chunks), strings.size)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            offsets = []
+            offset = HEADER.size
+            for name in SECTIONS:
+                data, count = sections[name]
+                offsets += [offset, count]
+                offset += len(data)
+
+            f.write(HEADER.pack(MAGIC, *offsets))
+            for name in SECTIONS:
+                f.write(sections[name][0])
+
+        # mkstemp() creates files only readable by their owner
+        os.chmod(temporary, 0644)
+        os.rename(temporary, path)
+    except:
+        os.remove(temporary)
+        raise
+
+
+class Table(object):
+    """
+    Records of a model in a snapshot, with lookups by pk, geoname_id and
+    code.
+    """
+
+    def __init__(self, snapshot, section, fields, record_class,
+            geoname_ids, codes=None):
+        self.snapshot = snapshot
+        self.data = snapshot.data
+        self.offset, self.count = snapshot.sections[section]
+        self.struct = record_struct(fields)
+        self.fields = fields[0]
+        self.numbers = len(fields[0])
+        self.record_class = record_class
+        self.geoname_ids = snapshot.sections[geoname_ids]
+        self.codes = snapshot.sections[codes] if codes else (0, 0)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, number):
+        if not 0 <= number < self.count:
+            raise IndexError(number)
+
+        values = self.struct.unpack_from(self.data,
+            self.offset + number * self.struct.size)
+
+        # 0 stands for no geoname_id or foreign key, and nan for no
+        # coordinates, see _pack_records()
+        fields = [values[0]]
+        for field, value in zip(self.fields[1:], values[1:self.numbers]):
+            if field in ('latitude', 'longitude'):
+                fields.append(None if value != value else value)
+            else:
+                fields.append(value or None)
+        for i in range(self.numbers, len(values), 2):
+            fields.append(self.snapshot.string(values[i], values[i + 1]))
+
+        return self.record_class(*fields)
+
+    def __iter__(self):
+        for number in range(self.count):
+            yield self[number]
+
+    def _bisect(self, offset, count, size, key, read):
+        """
+        Return the number of the first item of a sorted section of which
+        read(offset of the item) is not lower than key.
+        """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if read(offset + middle * size) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, pk):
+        """
+        Return the record with the given pk, or None.
+        """
+        def read(offset):
+            return struct.unpack_from('<i', self.data, offset)[0]
+
+        number = self._bisect(self.offset, self.count, self.struct.size,
+            pk, read)
+
+        if number < self.count and read(
+                self.offset + number * self.struct.size) == pk:
+            return self[number]
+
+    def by_geoname_id(self, geoname_id):
+        """
+        Return the record with the given geoname_id, or None.
+        """
+        offset, count = self.geoname_ids
+
+        def read(offset):
+            return INTEGER_KEY.unpack_from(self.data, offset)[0]
+
+        i = self._bisect(offset, count, INTEGER_KEY.size, geoname_id, read)
+
+        if i < count:
+            key, number = INTEGER_KEY.unpack_from(self.data,
+                offset + i * INTEGER_KEY.size)
+            if key == geoname_id:
+                return self[number]
+
+    def by_code(self, code):
+        """
+        Return the record with the given code, or None: code2 or code3 for
+        countries, country code2 and geoname_code separated by a dot for
+        regions, ie. 'FR.11'.
+        """
+        offset, count = self.codes
+        code = code.encode('utf-8') if isinstance(code, unicode) else code
+
+        def read(offset):
+            start, length, number = STRING_KEY.unpack_from(self.data, offset)
+            return self.snapshot.bytes(start, length)
+
+        i = self._bisect(offset, count, STRING_KEY.size, code, read)
+        if i < count:
+            start, length, number = STRING_KEY.unpack_from(self.data,
+                offset + i * STRING_KEY.size)
+            if self.snapshot.bytes(start, length) == code:
+                return self[number]
+
+
+class Snapshot(object):
+    """
+    Memory-mapped snapshot, with countries, regions and cities Tables.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        values = HEADER.unpack_from(self.data, 0)
+        if values[0] != MAGIC:
+            self.data.close()
+            raise ValueError('%s is not a cities_light snapshot' % path)
+
+        self.sections = dict((name, values[1 + i * 2:3 + i * 2])
+            for i, name in enumerate(SECTIONS))
+        self.strings_offset = self.sections['strings'][0]
+
+        self.countries = Table(self, 'countries', COUNTRY_FIELDS,
+            CountryRecord, 'country_geoname_ids', 'country_codes')
+        self.regions = Table(self, 'regions', REGION_FIELDS, RegionRecord,
+            'region_geoname_ids', 'region_codes')
+        self.cities = Table(self, 'cities', CITY_FIELDS, CityRecord,
+            'city_geoname_ids')
+
+    def bytes(self, offset, length):
+        start = self.strings_offset + offset
+        return self.data[start:start + length]
+
+    def string(self, offset, length):
+        return self.bytes(offset, length).decode('utf-8')
+
+    def close(self):
+        self.data.close()
@@ -0,0 +1,296 @@
+"""
+In-process spatial index of cities, to find the cities nearest to a point
+without querying the database.
+
+Coordinates are converted to points on the unit sphere, where the straight
+line distance between two points grows with their great-circle distance:
+the nearest points found by a KD-tree are the nearest cities, including
+across the antimeridian and near the poles. Distances are converted back to
+kilometers.
+
+The KD-tree is scipy's cKDTree if scipy is installed, else KDTree which only
+needs numpy. The index is built from the database the first time it is
+needed in a process, dropped when the process saves or deletes a city, and
+built again after SPATIAL_INDEX_TIMEOUT seconds to see changes made by other
+processes.
+"""
+
+import heapq
+import math
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import signals
+
+from .distance import load_coordinates
+from .geohash import EARTH_RADIUS
+from .models import City
+from .settings import SPATIAL_INDEX_TIMEOUT
+
+__all__ = ['KDTree', 'SpatialIndex', 'get_index', 'nearest',
+    'EARTH_RADIUS']
+
+
+def to_points(latitudes, longitudes):
+    """
+    Return the (n, 3) array of the points of the unit sphere at the given
+    coordinates, in degrees.
+    """
+    latitudes = numpy.radians(numpy.asarray(latitudes, dtype=numpy.float64))
+    longitudes = numpy.radians(numpy.asarray(longitudes,
+        dtype=numpy.float64))
+    cos_latitudes = numpy.cos(latitudes)
+
+    return numpy.column_stack((cos_latitudes * numpy.cos(longitudes),
+        cos_latitudes * numpy.sin(longitudes), numpy.sin(latitudes)))
+
+
+def to_point(latitude, longitude):
+    """
+    Return the point of the unit sphere at the given coordinates, like
+    to_points() without numpy overhead for a single point.
+    """
+    latitude = math.radians(float(latitude))
+    longitude = math.radians(float(longitude))
+    cos_latitude = math.cos(latitude)
+
+    return (cos_latitude * math.cos(longitude),
+        cos_latitude * math.sin(longitude), math.sin(latitude))
+
+
+def to_kilometers(chords):
+    """
+    Return the great-circle distances of the given straight line distances
+    between points of the unit sphere.
+    """
+    chords = numpy.clip(numpy.asarray(chords, dtype=numpy.float64), 0, 2)
+    return 2 * EARTH_RADIUS * numpy.arcsin(chords / 2)
+
+
+class KDTree(object):
+    """
+    KD-tree over an (n, dimensions) array of points, with a query() method
+    like scipy's cKDTree.
+
+    Nodes split the widest dimension of their points at the median, until
+    they hold at most leaf_size points. The points of each node are
+    contiguous in self.points, so that leaves are compared with a query in
+    a single numpy operation.
+    """
+
+    def __init__(self, points, leaf_size=32):
+        points = numpy.asarray(points, dtype=numpy.float64)
+        self.indices = numpy.arange(len(points))
+        self.leaf_size = leaf_size
+
+        # by node: (start, end) of its points, and (dimension, split value,
+        # left child, right child) or None for leaves
+        self.ranges = []
+        self.splits = []
+
+        if len(points):
+            self._build(points, 0, len(points))
+
+        self.points = points[self.indices]
+
+    def _build(self, points, start, end):
+        node = len(self.ranges)
+        self.ranges.append((start, end))
+        self.splits.append(None)
+
+        if end - start > self.leaf_size:
+            indices = self.indices[start:end]
+            node_points = points[indices]
+            dimension = int(numpy.argmax(node_points.max(axis=0) -
+                node_points.min(axis=0)))
+
+            # points of the left child are before the split value, points of
+            # the right child after it
+            middle = (end - start) // 2
+            order = numpy.argpartition(node_points[:, dimension], middle)
+            self.indices[start:end] = indices[order]
+            split = float(node_points[order[middle], dimension])
+
+            left = self._build(points, start, start + middle)
+            right = self._build(points, start + middle, end)
+            self.splits[node] = (dimension, split, left, right)
+
+        return node
+
+    def query(self, points, k=1):
+        """
+        Return the arrays of the distances and of the indices of the k points
+        nearest to a point, nearest first, or the (m, k) arrays of those of
+        each of an (m, dimensions) array of points.
+        """
+        points = numpy.asarray(points, dtype=numpy.float64)
+        if points.ndim == 1:
+            return self._query(points, k)
+
+        distances = numpy.empty((len(points), k))
+        indices = numpy.empty((len(points), k), dtype=int)
+        for i, point in enumerate(points):
+            distances[i], indices[i] = self._query(point, k)
+
+        return distances, indices
+
+    def _query(self, point, k):
+        point = tuple(float(value) for value in point)
+        query = numpy.array(point)
+        splits = self.splits
+
+        # max-heap of the best (-squared distance, index) found so far
+        best = []
+        # nodes to visit, with a lower bound of their squared distance
+        nodes = [(0., 0)] if self.ranges else []
+
+        while nodes:
+            bound, node = nodes.pop()
+            if len(best) == k and bound >= -best[0][0]:
+                continue
+
+            # go down to the leaf of point, leaving the other sides for later
+            while splits[node] is not None:
+                dimension, split, left, right = splits[node]
+                difference = point[dimension] - split
+                if difference < 0:
+                    node, other = left, right
+                else:
+                    node, other = right, left
+                nodes.append((max(bound, difference * difference), other))
+
+            start, end = self.ranges[node]
+            distances = ((self.points[start:end] - query) ** 2).sum(axis=1)
+            for i in numpy.argsort(distances)[:k]:
+                item = (-distances[i], self.indices[start + i])
+                if len(best) < k:
+                    heapq.heappush(best, item)
+                elif item > best[0]:
+                    heapq.heapreplace(best, item)
+                else:
+                    break
+
+        best.sort(reverse=True)
+        return (numpy.sqrt([-distance for distance, index in best]),
+            numpy.array([index for distance, index in best], dtype=int))
+
+
+class SpatialIndex(object):
+    """
+    KD-tree over the coordinates of cities, with their pks.
+    """
+
+    def __init__(self, pks, latitudes, longitudes):
+        if numpy is None:
+            raise ImproperlyConfigured(
+                'Install numpy to use cities_light.spatial')
+
+        self.pks = numpy.asarray(pks, dtype=numpy.int64)
+        points = to_points(latitudes, longitudes)
+        if cKDTree is not None:
+            self.tree = cKDTree(points)
+        else:
+            self.tree = KDTree(points)
+        self.created = time.time()
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        """
+        Return the SpatialIndex of the cities of queryset which have
+        coordinates.
+        """
+        return cls(*load_coordinates(queryset))
+
+    def __len__(self):
+        return len(self.pks)
+
+    def expired(self, timeout=SPATIAL_INDEX_TIMEOUT):
+        return timeout is not None and time.time() - self.created > timeout
+
+    def nearest(self, latitude, longitude, k=1):
+        """
+        Return the list of the (pk, distance in kilometers) of the k cities
+        nearest to the given coordinates, nearest first.
+        """
+        k = min(k, len(self.pks))
+        if not k:
+            return []
+
+        distances, indices = self.tree.query(to_point(latitude, longitude), k)
+
+        # cKDTree returns scalars when k is 1
+        distances = numpy.atleast_1d(distances)
+        indices = numpy.atleast_1d(indices)
+
+        return zip(self.pks[indices].tolist(),
+            to_kilometers(distances).tolist())
+
+    def nearest_many(self, points, k=1):
+        """
+        Return, for each (latitude, longitude) of points, the list nearest()
+        would return, querying the tree with all points at once.
+        """
+        k = min(k, len(self.pks))
+        if not k or not len(points):
+            return [[] for point in points]
+
+        latitudes, longitudes = zip(*points)
+        distances, indices = self.tree.query(to_points(latitudes,
+            longitudes), k)
+
+        # cKDTree returns (m, ) arrays when k is 1
+        distances = to_kilometers(distances).reshape((len(points), k))
+        pks = self.pks[indices].reshape((len(points), k))
+
+        return [zip(row_pks, row_distances) for row_pks, row_distances in
+            zip(pks.tolist(), distances.tolist())]
+
+
+# SpatialIndex of all cities, built by get_index()
+_index = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Return the SpatialIndex of all cities, building it if the process does
+    not have it yet or if it expired.
+    """
+    global _index
+
+    index = _index
+    if index is None or index.expired():
+        with _lock:
+            # another thread may have built it while this one waited
+            index = _index
+            if index is None or index.expired():
+                index = _index = SpatialIndex.from_queryset(
+                    City.objects.all())
+
+    return index
+
+
+def nearest(latitude, longitude, k=1):
+    """
+    Return the (pk, distance in kilometers) of the k cities nearest to the
+    given coordinates, from the index of all cities.
+    """
+    return get_index().nearest(latitude, longitude, k)
+
+
+def clear_index(sender, **kwargs):
+    global _index
+    _index = None
+signals.post_save.connect(clear_index, sender=City)
+signals.post_delete.connect(clear_index, sender=City)
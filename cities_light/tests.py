@@ -1,9 +1,48 @@
 # -*- encoding: utf-8 -*-
 
+import BaseHTTPServer
+import datetime
+import gzip
+import hashlib
+import json
+import multiprocessing.pool
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from decimal import Decimal
+
+from django.contrib.auth.models import AnonymousUser
+from django.core import urlresolvers
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import signals
+from django.test.client import RequestFactory
 from django.utils import unittest
 
+from .bulk import bulk_update
 from .forms import CountryForm, CityForm
-from .models import Country, City
+from .geonames import Geonames, CITY_COLUMNS, integer, real, text
+from .exceptions import InvalidSource
+from .management.commands.cities_light import (Command, CityFilter,
+    CountryFilter)
+from .denormalize import defer_denormalization, denormalize
+from .lru import lru_cache
+from .management.commands import cities_light as cities_light_command
+from . import distance, geohash, geonames, prefix_index, spatial
+from .models import (Country, Region, City, CitySearchKey,
+    build_search_names, cache_search_names, city_search_keys, to_ascii,
+    to_search, to_ascii_batch, to_search_batch)
+from .signals import (city_items_batch_pre_import, city_items_pre_import,
+    filter_non_cities, is_connected, has_other_receivers)
+from .snapshot import Snapshot, write_snapshot
+from .translations import TranslationSpool, TranslationCache
+
+try:
+    from .contrib import restframework
+except ImportError:
+    restframework = None
 
 
 class FormTestCase(unittest.TestCase):
@@ -34,3 +73,1325 @@ class SaveTestCase(unittest.TestCase):
 
         self.assertEqual(city.name_ascii, u'ao eu')
         self.assertEqual(city.slug, u'ao-eu')
+
+    def testCitySearchNames(self):
+        country = Country(name=u'Searchland', code2='SL',
+            alternate_names=u'Searchia')
+        country.save()
+        region = Region(name=u'Search Region', country=country)
+        region.save()
+        city = City(name=u'Search city', country=country, region=region,
+            alternate_names=u'Searchville,Search City')
+
+        with cache_search_names():
+            city.save()
+
+            self.assertEqual(city.search_names, u' '.join([
+                'searchcitysearchland', 'searchcitysearchregionsearchland',
+                'searchcitysearchia', 'searchcitysearchregionsearchia',
+                'searchvillesearchland', 'searchvillesearchregionsearchland',
+                'searchvillesearchia', 'searchvillesearchregionsearchia']))
+
+            # cached names of the region are invalidated when it is saved
+            region.alternate_names = u'Région'
+            region.save()
+            city.alternate_names = u''
+            city.save()
+            self.assertEqual(city.search_names, u' '.join([
+                'searchcitysearchland', 'searchcitysearchregionsearchland',
+                'searchcityregionsearchland', 'searchcitysearchia',
+                'searchcitysearchregionsearchia', 'searchcityregionsearchia']))
+
+        # names changed by another process are seen outside of imports
+        Region.objects.filter(pk=region.pk).update(alternate_names=u'')
+        city = City.objects.get(pk=city.pk)
+        city.save()
+        self.assertEqual(city.search_names, u' '.join([
+            'searchcitysearchland', 'searchcitysearchregionsearchland',
+            'searchcitysearchia', 'searchcitysearchregionsearchia']))
+
+        country.delete()
+
+    def testBuildSearchNames(self):
+        self.assertEqual(build_search_names(['a', 'b'], [], ['x', 'x']),
+            'ax bx')
+        self.assertEqual(build_search_names(['a'], ['r', ''], ['x']),
+            'ax arx')
+
+
+class NormalizationTestCase(unittest.TestCase):
+    def testLruCache(self):
+        calls = []
+
+        @lru_cache(2)
+        def double(value):
+            calls.append(value)
+            return value * 2
+
+        self.assertEqual(map(double, [1, 2, 1, 3, 1, 2]), [2, 4, 2, 6, 2, 4])
+        # 2 was the least recently used when 3 was added
+        self.assertEqual(calls, [1, 2, 3, 2])
+
+        double.cache_clear()
+        double(1)
+        self.assertEqual(calls, [1, 2, 3, 2, 1])
+
+    def testBatch(self):
+        values = [u'Saint-Étienne', 'Paris Texas', u'Ærøskøbing', u'',
+            u'ﬁ_x', u'東京']
+
+        self.assertEqual(to_ascii_batch(values), map(to_ascii, values))
+        self.assertEqual(to_search_batch(values), map(to_search, values))
+        self.assertEqual(to_search_batch(values), ['saintetienne',
+            'paristexas', 'rskbing', '', 'fix', ''])
+
+        # the separator of the batch is in a value
+        self.assertEqual(to_search_batch([u'a\x00b', u'c']), ['ab', 'c'])
+
+
+class BulkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Bulkland', code2='BL')
+        self.country.save()
+
+    def tearDown(self):
+        self.country.delete()
+
+    def city_items(self, geoname_id, name, latitude=1.5, longitude=2.5):
+        return [geoname_id, name, name, u'', latitude, longitude, 'P', 'PPL',
+            'BL', '', '01', None, None, None, 1000]
+
+    def testBulkUpdate(self):
+        first = City(name=u'Bulk one', country=self.country)
+        first.save()
+        second = City(name=u'Bulk two', country=self.country)
+        second.save()
+
+        first.latitude = Decimal('10.5')
+        second.name_ascii = u'bulk 2'
+        bulk_update(City, [first, second], ['latitude', 'name_ascii'])
+
+        self.assertEqual(City.objects.get(pk=first.pk).latitude,
+            Decimal('10.5'))
+        self.assertEqual(City.objects.get(pk=second.pk).name_ascii,
+            u'bulk 2')
+
+    def testCityImportBulk(self):
+        existing = City(name=u'Bulk old', country=self.country,
+            geoname_id=9990001)
+        existing.save()
+
+        command = Command()
+        command.noinsert = False
+        command.bulk = True
+        command._city_batch = []
+
+        command.city_import(self.city_items(9990001, u'Bulk old'))
+        command.city_import(self.city_items(9990002, u'Bulk new'))
+        command.city_import(self.city_items(9990002, u'Bulk new'))
+        self.assertEqual(City.objects.filter(country=self.country).count(),
+            1)
+
+        command.city_flush()
+
+        cities = City.objects.filter(country=self.country).order_by(
+            'geoname_id')
+        self.assertEqual([c.geoname_id for c in cities], [9990001, 9990002])
+        self.assertEqual(cities[0].pk, existing.pk)
+        self.assertEqual(cities[0].latitude, Decimal('1.5'))
+        self.assertEqual(cities[1].display_name, u'Bulk new, Bulkland')
+        self.assertEqual(list(City.objects.search(u'bulk new').values_list(
+            'pk', flat=True)), [cities[1].pk])
+
+    def testCityFlushQueries(self):
+        region = Region(name=u'Bulk region', country=self.country,
+            geoname_code='01')
+        region.save()
+
+        command = Command()
+        command.noinsert = False
+        command.bulk = True
+        command._city_batch = []
+        command._load_city_ids()
+        command._get_region_id('BL', '01')
+
+        def flush(start, count):
+            for i in range(start, start + count):
+                command._city_batch.append((self.country.pk,
+                    self.city_items(9990100 + i, u'Bulk city %s' % i)))
+
+            connection.use_debug_cursor = True
+            connection.queries = []
+            try:
+                command.city_flush()
+            finally:
+                connection.use_debug_cursor = None
+
+            return len(connection.queries)
+
+        # the number of queries does not depend on the size of the batch
+        self.assertEqual(flush(0, 2), flush(2, 20))
+
+        city = City.objects.get(geoname_id=9990110)
+        self.assertEqual(city.display_name,
+            u'Bulk city 10, Bulk region, Bulkland')
+
+    def testCityImportSkipsCompleteCities(self):
+        region = Region(name=u'Bulk region', country=self.country,
+            geoname_code='01')
+        region.save()
+        complete = City(name=u'Bulk complete', country=self.country,
+            region=region, geoname_id=9990003, latitude=Decimal('3.5'),
+            longitude=Decimal('4.5'), alternate_names=u'Bulky')
+        complete.save()
+
+        command = Command()
+        command.noinsert = False
+        command.bulk = False
+        command._load_city_ids()
+        self.assertTrue(complete.pk in command._complete_city_ids)
+
+        command.city_import(self.city_items(9990003, u'Bulk complete'))
+        command.city_import(self.city_items(9990004, u'Bulk other'))
+
+        self.assertEqual(City.objects.get(pk=complete.pk).latitude,
+            Decimal('3.5'))
+        other = City.objects.get(geoname_id=9990004)
+        self.assertEqual(other.region_id, region.pk)
+        self.assertEqual(command._get_city_id(self.country.pk,
+            u'Bulk other', '0'), (other.pk, False))
+
+
+class DenormalizeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Denormaland', code2='DL',
+            alternate_names=u'Denormalia')
+        self.country.save()
+
+    def tearDown(self):
+        self.country.delete()
+
+    def testDenormalize(self):
+        with defer_denormalization():
+            region = Region(name=u'Denormal region', country=self.country)
+            region.save()
+            city = City(name=u'Dénormal city', region=region,
+                country=self.country)
+            city.save()
+
+        self.assertEqual(city.display_name, u'')
+        self.assertEqual(city.search_names, u'')
+        self.assertEqual(city.name_ascii, u'Denormal city')
+
+        saved = City(name=u'Saved city', region=region, country=self.country)
+        saved.save()
+
+        for model, count in denormalize(batch_size=2):
+            self.assertTrue(count <= 2)
+
+        city = City.objects.get(pk=city.pk)
+        self.assertEqual(city.display_name,
+            u'Dénormal city, Denormal region, Denormaland')
+        self.assertEqual(Region.objects.get(pk=region.pk).display_name,
+            u'Denormal region, Denormaland')
+
+        # same as if the receivers had been connected
+        city.save()
+        self.assertEqual(City.objects.get(pk=city.pk).search_names,
+            city.search_names)
+        self.assertEqual(City.objects.get(pk=saved.pk).search_names,
+            saved.search_names)
+        self.assertEqual(list(City.objects.search(u'denormal city')), [city])
+
+
+class SearchKeyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Searchland', code2='SL',
+            alternate_names=u'Searchia')
+        self.country.save()
+        self.city = City(name=u'Sainte-Recherche', country=self.country,
+            alternate_names=u'Recherche')
+        self.city.save()
+
+    def tearDown(self):
+        self.country.delete()
+
+    def keys(self):
+        return sorted(self.city.search_keys.values_list('key', flat=True))
+
+    def testSearchKeys(self):
+        self.assertEqual(self.keys(), sorted(self.city.search_names.split()))
+
+        self.city.alternate_names = u''
+        self.city.save()
+        self.assertEqual(self.keys(), ['sainterecherchesearchia',
+            'sainterecherchesearchland'])
+        self.assertEqual(CitySearchKey.objects.filter(
+            key__startswith='recherche').count(), 0)
+
+    def testSearch(self):
+        for query in (u'Sainte Rech', u'recherche, searchia', u'SAINTE'):
+            self.assertEqual(list(City.objects.search(query)), [self.city])
+
+        self.assertEqual(list(City.objects.search(u'Searchland').filter(
+            country=self.country)), [])
+        self.assertEqual(City.objects.search(u', ').filter(
+            country=self.country).count(), 1)
+
+
+class PrefixIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Prefixland', code2='PX',
+            alternate_names=u'Prefixia,Préfixe')
+        self.country.save()
+
+    def tearDown(self):
+        self.country.delete()
+
+    def testSearch(self):
+        index = prefix_index.PrefixIndex([('parisfrance', 1),
+            ('paris', 2), ('parisfrance', 1), ('parisiledefrance', 1),
+            ('pau', 3), ('lyon', 4)])
+
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.search(u'Paris'), [2, 1])
+        self.assertEqual(index.search(u'pa'), [2, 1, 3])
+        self.assertEqual(index.search(u'pa', limit=2), [2, 1])
+        self.assertEqual(index.search(u'zurich'), [])
+        self.assertEqual(index.search(u' - '), [])
+
+    def testGetIndex(self):
+        self.assertEqual(prefix_index.search(Country, u'prefix'),
+            [self.country.pk])
+        self.assertEqual(prefix_index.search(Country, u'prefixe'),
+            [self.country.pk])
+
+        # saving drops the index, which is built again with the change
+        self.country.alternate_names = u''
+        self.country.save()
+        self.assertEqual(prefix_index.search(Country, u'prefixe'), [])
+
+        city = City(name=u'Prefix city', country=self.country)
+        city.save()
+        pks = prefix_index.search(City, u'prefix city, prefixland')
+        self.assertEqual(prefix_index.in_order(City.objects.all(), pks),
+            [city])
+
+
+class GeohashTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Geohashland', code2='GH')
+        self.country.save()
+
+        for name, latitude, longitude in ((u'Paris', '48.85341', '2.3488'),
+                (u'Versailles', '48.80359', '2.13424'),
+                (u'Lyon', '45.74846', '4.84671'),
+                (u'Suva', '-18.14161', '178.44149'),
+                (u'Apia', '-13.83333', '-171.76666')):
+            City(name=name, country=self.country, latitude=latitude,
+                longitude=longitude).save()
+
+    def tearDown(self):
+        self.country.delete()
+
+    def names(self, cities):
+        return sorted(city.name for city in cities)
+
+    def testEncode(self):
+        self.assertEqual(geohash.encode(57.64911, 10.40744, 11),
+            'u4pruydqqvj')
+
+        south, west, north, east = geohash.decode('u4pruydqqvj')
+        self.assertTrue(south <= 57.64911 <= north)
+        self.assertTrue(west <= 10.40744 <= east)
+
+    def testBboxRanges(self):
+        ranges = geohash.bbox_ranges(48.4, 1.8, 49.3, 2.9)
+        self.assertEqual(ranges, [('u09', 'u0b'), ('u0c', 'u0e'),
+            ('u0f', 'u0g')])
+
+        # across the antimeridian
+        ranges = geohash.bbox_ranges(-20, 178, -10, -170)
+        self.assertTrue(('ru', 'rw') in ranges)
+        self.assertTrue(('2h', '2k') in ranges)
+
+        self.assertEqual(geohash.bbox_ranges(-90, -180, 90, 180), [])
+
+    def testCityGeohash(self):
+        city = City.objects.get(name=u'Paris', country=self.country)
+        self.assertEqual(city.geohash, 'u09tvmqrep8n')
+
+        city.latitude = None
+        city.save()
+        self.assertEqual(city.geohash, '')
+
+    def testInBbox(self):
+        cities = City.objects.filter(country=self.country)
+        self.assertEqual(self.names(cities.in_bbox(48, 2, 49, 3)),
+            [u'Paris', u'Versailles'])
+        self.assertEqual(self.names(cities.in_bbox(-20, 170, -10, -170)),
+            [u'Apia', u'Suva'])
+
+    def testWithin(self):
+        cities = City.objects.filter(country=self.country)
+        self.assertEqual([c.name for c in cities.within(48.85, 2.35, 20)],
+            [u'Paris', u'Versailles'])
+        self.assertEqual([c.name for c in cities.within(48.85, 2.35, 10)],
+            [u'Paris'])
+        self.assertAlmostEqual(cities.within(48.85, 2.35, 1)[0].distance,
+            0.4, delta=0.1)
+
+        # Apia is about 1150km away from Suva, across the antimeridian
+        self.assertEqual([c.name for c in cities.within(-18, 178.4, 1200)],
+            [u'Suva', u'Apia'])
+        self.assertEqual(len(cities.within(89, 0, 5000)), 3)
+
+
+@unittest.skipIf(distance.numpy is None, 'numpy is not installed')
+class DistanceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Distanceland', code2='DX')
+        self.country.save()
+
+        self.cities = []
+        for name, latitude, longitude in ((u'Paris', '48.85341', '2.3488'),
+                (u'Lyon', '45.74846', '4.84671'),
+                (u'Suva', '-18.14161', '178.44149')):
+            city = City(name=name, country=self.country, latitude=latitude,
+                longitude=longitude)
+            city.save()
+            self.cities.append(city)
+        City(name=u'Nowhere', country=self.country).save()
+
+        self.coordinates = distance.CityCoordinates.from_queryset(
+            City.objects.filter(country=self.country))
+
+    def tearDown(self):
+        self.country.delete()
+
+    def testHaversine(self):
+        self.assertAlmostEqual(distance.haversine(48.85341, 2.3488,
+            45.74846, 4.84671), geohash.haversine(48.85341, 2.3488,
+            45.74846, 4.84671))
+
+        distances = distance.haversine(0, 0, [0, 0], [0, 180])
+        self.assertEqual(distances[0], 0)
+        self.assertAlmostEqual(distances[1], 3.14159 * geohash.EARTH_RADIUS,
+            delta=1)
+
+    def testCityCoordinates(self):
+        paris, lyon, suva = [city.pk for city in self.cities]
+        self.assertEqual(len(self.coordinates), 3)
+
+        distances = self.coordinates.distances([48.85, -18], [2.35, 178])
+        self.assertEqual(distances.shape, (2, 3))
+
+        self.assertEqual(self.coordinates.within(48.85, 2.35, 500).tolist(),
+            [paris, lyon])
+
+        pks, distances = self.coordinates.nearest([45.7, -18], [4.8, 178],
+            k=2)
+        self.assertEqual(pks.tolist(), [[lyon, paris], [suva, paris]])
+        self.assertTrue(distances[0][0] < 10)
+
+        pks, distances = self.coordinates.nearest(48.85, 2.35, k=5)
+        self.assertEqual(pks.tolist(), [[paris, lyon, suva]])
+
+
+@unittest.skipIf(spatial.numpy is None, 'numpy is not installed')
+class SpatialTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Spatialland', code2='SX')
+        self.country.save()
+
+        for name, latitude, longitude in ((u'Paris', '48.85341', '2.3488'),
+                (u'Lyon', '45.74846', '4.84671'),
+                (u'Suva', '-18.14161', '178.44149'),
+                (u'Apia', '-13.83333', '-171.76666')):
+            City(name=name, country=self.country, latitude=latitude,
+                longitude=longitude).save()
+        City(name=u'Nowhere', country=self.country).save()
+
+    def tearDown(self):
+        self.country.delete()
+
+    def testKDTree(self):
+        rng = spatial.numpy.random.RandomState(0)
+        points = rng.uniform(-1, 1, (500, 3))
+        tree = spatial.KDTree(points, leaf_size=4)
+
+        queries = rng.uniform(-1, 1, (20, 3))
+        for query in queries:
+            expected = ((points - query) ** 2).sum(axis=1).argsort()[:3]
+            distances, indices = tree.query(query, 3)
+            self.assertEqual(indices.tolist(), expected.tolist())
+
+        # like cKDTree, many points are queried at once
+        distances, indices = tree.query(queries, 3)
+        self.assertEqual(indices.shape, (20, 3))
+        self.assertEqual(indices[5].tolist(), tree.query(queries[5],
+            3)[1].tolist())
+
+        self.assertEqual(len(spatial.KDTree([]).query((0, 0, 0))[1]), 0)
+
+    def testNearest(self):
+        cities = City.objects.nearest(48.8, 2.3, k=2)
+        self.assertEqual([c.name for c in cities], [u'Paris', u'Lyon'])
+        self.assertAlmostEqual(cities[1].distance, 390, delta=1)
+
+        # across the antimeridian, Suva is nearer than Paris to Apia
+        cities = City.objects.nearest(-13.8, 179.9, k=1)
+        self.assertEqual([c.name for c in cities], [u'Suva'])
+
+        # cities without coordinates are not indexed, saving drops the index
+        self.assertEqual(len(City.objects.nearest(0, 0, k=10)), 4)
+        City(name=u'Quito', country=self.country, latitude='-0.22985',
+            longitude='-78.52495').save()
+        self.assertEqual(City.objects.nearest(0, -80)[0].name, u'Quito')
+
+    def testNearestMany(self):
+        index = spatial.get_index()
+        points = [(48.8, 2.3), (-13.8, 179.9), (45.7, 4.8)]
+
+        for k in (1, 2):
+            results = index.nearest_many(points, k=k)
+            self.assertEqual(results, [index.nearest(latitude, longitude, k)
+                for latitude, longitude in points])
+            self.assertEqual(len(results[0]), k)
+
+        self.assertEqual(index.nearest_many([]), [])
+
+
+@unittest.skipIf(restframework is None,
+    'djangorestframework is not installed')
+class NearestCityViewTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Nearland', code2='NX')
+        self.country.save()
+        self.paris = City(name=u'Paris', country=self.country,
+            latitude='48.85341', longitude='2.3488')
+        self.paris.save()
+        self.lyon = City(name=u'Lyon', country=self.country,
+            latitude='45.74846', longitude='4.84671')
+        self.lyon.save()
+
+        self.view = restframework.NearestCityView.as_view()
+
+    def tearDown(self):
+        self.country.delete()
+
+    def post(self, content):
+        request = RequestFactory().post('/city/nearest/',
+            json.dumps(content), content_type='application/json',
+            HTTP_ACCEPT='application/json')
+        request.user = AnonymousUser()
+
+        response = self.view(request)
+        return response.status_code, json.loads(response.content)
+
+    def testUrl(self):
+        # declared before the detail url, which would match it too
+        self.assertEqual(urlresolvers.resolve('/city/nearest/',
+            restframework).url_name, 'cities_light_api_city_nearest')
+        self.assertEqual(urlresolvers.resolve('/city/1/',
+            restframework).url_name, 'cities_light_api_city_detail')
+
+    def testNearest(self):
+        status, content = self.post({'points': [[48.85, 2.35],
+            [45.75, 4.85]], 'k': 2})
+
+        self.assertEqual(status, 200)
+        self.assertEqual([[city['id'] for city in result]
+            for result in content], [[self.paris.pk, self.lyon.pk],
+            [self.lyon.pk, self.paris.pk]])
+        self.assertEqual(content[0][0]['display_name'], u'Paris, Nearland')
+        self.assertTrue(content[0][0]['distance'] < 1)
+        self.assertTrue(390 < content[0][1]['distance'] < 395)
+
+        status, content = self.post({'points': [[45.75, 4.85]]})
+        self.assertEqual(status, 200)
+        self.assertEqual([city['id'] for city in content[0]], [self.lyon.pk])
+
+    def testInvalid(self):
+        for content in ([[48.85, 2.35]], {'k': 1}, {'points': 'Paris'},
+                {'points': [[48.85]]}, {'points': [['north', 2.35]]},
+                {'points': [[91, 0]]}, {'points': [[0, 181]]},
+                {'points': [[0, 0]] * 1001},
+                {'points': [[0, 0]], 'k': 0},
+                {'points': [[0, 0]], 'k': 11},
+                {'points': [[0, 0]], 'k': 'all'}):
+            status, response = self.post(content)
+            self.assertEqual(status, 400, content)
+            self.assertTrue(response['detail'])
+
+    def testWithoutNumpy(self):
+        def get_index():
+            raise ImproperlyConfigured('Install numpy')
+
+        original = restframework.spatial.get_index
+        restframework.spatial.get_index = get_index
+        try:
+            status, content = self.post({'points': [[48.85, 2.35]]})
+        finally:
+            restframework.spatial.get_index = original
+
+        self.assertEqual(status, 503)
+        self.assertEqual(content['detail'], u'Install numpy')
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Snapshotland', code2='SS', code3='SSS',
+            geoname_id=9960001, alternate_names=u'Snäpshotia')
+        self.country.save()
+        self.region = Region(name=u'Snapshot region', country=self.country,
+            geoname_code='01', geoname_id=9960002)
+        self.region.save()
+        self.city = City(name=u'Snapshot city', country=self.country,
+            region=self.region, geoname_id=9960003, latitude='1.5',
+            longitude='-2.25')
+        self.city.save()
+        self.nowhere = City(name=u'Nowhere', country=self.country)
+        self.nowhere.save()
+        self.null_island = City(name=u'Null island', country=self.country,
+            latitude='0.00000', longitude='0.00000')
+        self.null_island.save()
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot.bin')
+        write_snapshot(self.path, Country.objects.all(),
+            Region.objects.all(), City.objects.all())
+        self.snapshot = Snapshot(self.path)
+
+    def tearDown(self):
+        self.snapshot.close()
+        shutil.rmtree(self.directory)
+        self.country.delete()
+
+    def testLookups(self):
+        self.assertEqual(len(self.snapshot.cities), City.objects.count())
+
+        country = self.snapshot.countries.by_code('SS')
+        self.assertEqual(country, self.snapshot.countries.by_code(u'SSS'))
+        self.assertEqual(country, self.snapshot.countries.get(
+            self.country.pk))
+        self.assertEqual(country.name, u'Snapshotland')
+        self.assertEqual(country.alternate_names, u'Snäpshotia')
+
+        region = self.snapshot.regions.by_code('SS.01')
+        self.assertEqual(region.id, self.region.pk)
+        self.assertEqual(region.country_id, self.country.pk)
+        self.assertEqual(region.display_name,
+            u'Snapshot region, Snapshotland')
+
+        city = self.snapshot.cities.by_geoname_id(9960003)
+        self.assertEqual(city.id, self.city.pk)
+        self.assertEqual(city.region_id, self.region.pk)
+        self.assertEqual((city.latitude, city.longitude), (1.5, -2.25))
+        self.assertEqual(city.geohash, self.city.geohash)
+
+        nowhere = self.snapshot.cities.get(self.nowhere.pk)
+        self.assertEqual((nowhere.region_id, nowhere.geoname_id,
+            nowhere.latitude), (None, None, None))
+
+        null_island = self.snapshot.cities.get(self.null_island.pk)
+        self.assertEqual((null_island.latitude, null_island.longitude),
+            (0.0, 0.0))
+
+        self.assertEqual(self.snapshot.countries.by_code('XX'), None)
+        self.assertEqual(self.snapshot.cities.by_geoname_id(1), None)
+        self.assertEqual(self.snapshot.cities.get(0), None)
+
+    def testInvalid(self):
+        with open(self.path, 'wb') as f:
+            f.write('x' * 200)
+
+        self.assertRaises(ValueError, Snapshot, self.path)
+
+
+class TranslationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Translationland', code2='TL',
+            geoname_id=9980001)
+        self.country.save()
+        self.city = City(name=u'Translation city', country=self.country,
+            geoname_id=9980002)
+        self.city.save()
+
+    def tearDown(self):
+        self.country.delete()
+
+    def testTranslationParse(self):
+        command = Command()
+        command.translation_parse([1, 9980001, 'en', 'Tland', '', '', '',
+            ''])
+        command.translation_parse([2, 9980002, 'en', 'Tcity', '', '', '',
+            ''])
+        command.translation_parse([3, 9980002, 'xx', 'Ignored', '', '', '',
+            ''])
+        command.translation_parse([4, 9980003, 'en', 'Unknown', '', '', '',
+            ''])
+        command.translation_parse([5, 9980002, 'en', 'Short', '', '1', '',
+            ''])
+
+        self.assertEqual(command.translation_data[Country],
+            {9980001: {'en': ['Tland']}})
+        self.assertEqual(command.translation_data[City],
+            {9980002: {'en': ['Tcity']}})
+
+
+class TranslationSpoolTestCase(unittest.TestCase):
+    def testSpillAndMerge(self):
+        spool = TranslationSpool(budget=500)
+        spool.add('City', 2, 'en', 'b')
+        spool.add('City', 1, 'en', 'z')
+        spool.add('Country', 1, 'fr', 'x')
+        spool.add('City', 2, 'en', 'a')
+        spool.add('City', 1, 'de', 'y')
+
+        self.assertTrue(spool.runs)
+        self.assertEqual(list(spool), [
+            ('City', 1, {'en': ['z'], 'de': ['y']}),
+            ('City', 2, {'en': ['b', 'a']}),
+            ('Country', 1, {'fr': ['x']}),
+        ])
+        spool.close()
+
+
+class TranslationCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'alternateNames.txt')
+        with open(self.source, 'w') as f:
+            f.write('1\t2\ten\tfoo\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testWriteAndRead(self):
+        cache = TranslationCache(os.path.join(self.directory, 'cache'))
+        key = TranslationCache.make_key(self.source, ['en', 'fr'])
+        self.assertFalse(cache.is_valid(key))
+
+        groups = [
+            ('Country', 1, {'fr': ['x']}),
+            ('City', 2, {'en': ['b', 'a']}),
+        ]
+        cache.write(groups, key)
+
+        self.assertTrue(cache.is_valid(key))
+        self.assertEqual(cache.count, 3)
+        self.assertEqual(list(cache), groups)
+
+        self.assertFalse(cache.is_valid(TranslationCache.make_key(
+            self.source, ['en'])))
+
+
+class GeonamesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.geonames = Geonames.__new__(Geonames)
+        self.geonames.file_path = os.path.join(self.directory, 'cities.txt')
+
+        with open(self.geonames.file_path, 'w') as f:
+            f.write('# comment\n')
+            for i in range(100):
+                f.write('%s\tcity %s\t \tPPL\n' % (i, i))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testParseParallel(self):
+        self.geonames.chunk_size = 64
+
+        path = self.geonames.extract()
+        self.assertEqual(path, self.geonames.file_path)
+
+        ranges = self.geonames.byte_ranges(path)
+        self.assertTrue(len(ranges) > 2)
+        self.assertEqual(ranges[-1][2], os.path.getsize(path))
+
+        batches = list(self.geonames.parse_parallel(2))
+        self.assertEqual(self.geonames.position, self.geonames.size)
+        self.assertEqual(sum(batches, []), list(self.geonames.parse()))
+        self.assertEqual(len(sum(batches, [])), 100)
+
+    def testParseOffset(self):
+        rows = self.geonames.parse()
+        rows.next()
+        offset = self.geonames.offset
+        self.assertEqual(offset, len('# comment\n0\tcity 0\t \tPPL\n'))
+        self.assertEqual(list(rows), list(self.geonames.parse(offset)))
+        self.assertEqual(self.geonames.offset, self.geonames.size)
+
+        gz_path = self.geonames.file_path + '.gz'
+        with open(self.geonames.file_path, 'rb') as f:
+            gzip_file = gzip.open(gz_path, 'wb')
+            gzip_file.write(f.read())
+            gzip_file.close()
+
+        geonames = Geonames.__new__(Geonames)
+        geonames.file_path = gz_path
+        self.assertEqual(list(geonames.parse(offset))[0][0], '1')
+
+    def testParsePosition(self):
+        # position is the end of the last chunk read
+        self.geonames.read_size = 100
+        rows = self.geonames.parse()
+        rows.next()
+        self.assertEqual(self.geonames.position, 100)
+
+        list(rows)
+        self.assertEqual(self.geonames.position, self.geonames.size)
+
+    def testParseCompressedPosition(self):
+        # compressed sources advance by blocks of the compressed file
+        content = ''.join('%s\t%s\n' % (i, hashlib.md5(str(i)).hexdigest())
+            for i in range(1000))
+
+        geonames = Geonames.__new__(Geonames)
+        geonames.read_size = 100
+
+        geonames.file_path = os.path.join(self.directory, 'cities.zip')
+        zip_file = zipfile.ZipFile(geonames.file_path, 'w',
+            zipfile.ZIP_DEFLATED)
+        zip_file.writestr('cities.txt', content)
+        zip_file.close()
+
+        geonames.file_path = os.path.join(self.directory, 'cities.txt.gz')
+        gzip_file = gzip.open(geonames.file_path, 'wb')
+        gzip_file.write(content)
+        gzip_file.close()
+
+        for name in ('cities.zip', 'cities.txt.gz'):
+            geonames.file_path = os.path.join(self.directory, name)
+            rows = geonames.parse()
+            rows.next()
+            self.assertTrue(0 < geonames.position < geonames.size)
+
+            list(rows)
+            self.assertEqual(geonames.position, geonames.size)
+
+    def testParseCompressed(self):
+        rows = list(self.geonames.parse())
+        self.assertEqual(self.geonames.position, self.geonames.size)
+
+        with open(self.geonames.file_path, 'rb') as f:
+            content = f.read()
+
+        geonames = Geonames.__new__(Geonames)
+        geonames.read_size = 100
+
+        geonames.file_path = os.path.join(self.directory, 'cities.zip')
+        zip_file = zipfile.ZipFile(geonames.file_path, 'w',
+            zipfile.ZIP_DEFLATED)
+        zip_file.writestr('cities.txt', content)
+        zip_file.close()
+        self.assertEqual(list(geonames.parse()), rows)
+        self.assertEqual(geonames.position, geonames.size)
+
+        geonames.file_path = os.path.join(self.directory, 'cities.txt.gz')
+        gzip_file = gzip.open(geonames.file_path, 'wb')
+        gzip_file.write(content)
+        gzip_file.close()
+        self.assertEqual(list(geonames.parse()), rows)
+
+        os.remove(self.geonames.file_path)
+        self.assertEqual(geonames.extract(), self.geonames.file_path)
+        with open(self.geonames.file_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def testParseColumns(self):
+        geonames = Geonames.__new__(Geonames)
+        geonames.file_path = os.path.join(self.directory, 'cities15000.txt')
+        with open(geonames.file_path, 'w') as f:
+            f.write('2988507\tParis\tParis\tLutetia\t48.85341\t2.3488\tP'
+                '\tPPLC\tFR\t\t11\t75\t751\t75056\t2138551\t\t42\t'
+                'Europe/Paris\t2012-08-19\n')
+            f.write('\n# comment\n')
+            f.write('1\t\xc3\x89vry \n')
+
+        columns = ((0, integer), (1, text), (4, real), (14, integer))
+        self.assertEqual(list(geonames.parse(columns=columns)), [
+            [2988507, u'Paris', None, None, 48.85341, None, None, None, None,
+                None, None, None, None, None, 2138551],
+            [1, u'\xc9vry', None, None, None, None, None, None, None, None,
+                None, None, None, None, None],
+        ])
+
+        batches = geonames.parse_parallel(2, columns=CITY_COLUMNS)
+        self.assertEqual(sum(batches, []),
+            list(geonames.parse(columns=CITY_COLUMNS)))
+
+    def testValidate(self):
+        geonames = Geonames.__new__(Geonames)
+        geonames.file_path = os.path.join(self.directory, 'cities.zip')
+        zip_file = zipfile.ZipFile(geonames.file_path, 'w',
+            zipfile.ZIP_DEFLATED)
+        zip_file.write(self.geonames.file_path, 'cities.txt')
+        zip_file.close()
+        geonames.validate()
+
+        # truncated download
+        with open(geonames.file_path, 'rb') as f:
+            content = f.read()
+        with open(geonames.file_path, 'wb') as f:
+            f.write(content[:len(content) / 2])
+
+        self.assertRaises(InvalidSource, geonames.validate)
+        self.assertFalse(os.path.exists(geonames.file_path))
+
+
+class FilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.geonames = Geonames.__new__(Geonames)
+        self.geonames.file_path = os.path.join(self.directory, 'cities.txt')
+
+        with open(self.geonames.file_path, 'w') as f:
+            for geoname_id, feature, country, population in (
+                    (1, 'PPLC', 'FR', 2138551), (2, 'PPLX', 'FR', 20000),
+                    (3, 'PPL', 'BE', 1000), (4, 'ADM1', 'FR', 50000),
+                    (5, 'PPLA', 'DE', 300000)):
+                f.write('\t'.join([str(geoname_id), 'city', 'city', '', '1',
+                    '2', 'P', feature, country, '', '01', '', '', '',
+                    str(population), '', '', 'Europe/Paris', '2012-01-01']))
+                f.write('\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def geoname_ids(self, row_filter, columns=CITY_COLUMNS):
+        return [int(items[0]) for items in
+            self.geonames.parse(columns=columns, row_filter=row_filter)]
+
+    def testCityFilter(self):
+        self.assertEqual(self.geoname_ids(CityFilter(non_cities=True)),
+            [1, 2, 3, 5])
+        self.assertEqual(self.geoname_ids(CityFilter(
+            include_countries=['FR', 'BE'], exclude_types=['PPLX'])),
+            [1, 3, 4])
+        self.assertEqual(self.geoname_ids(CityFilter(
+            exclude_countries=['FR'], minimum_population=5000)), [5])
+        self.assertEqual(self.geoname_ids(CityFilter(
+            include_types=['PPLC', 'PPLA'])), [1, 5])
+
+        # without columns, the filter gets stripped rows
+        self.assertEqual(self.geoname_ids(CityFilter(
+            include_countries=['BE']), None), [3])
+
+    def testCityFilterUnstripped(self):
+        items = ['6', 'city', 'city', '', '1', '2', 'P', ' PPLA ', ' DE ',
+            '', '01', '', '', '', ' ']
+        self.assertTrue(CityFilter(include_countries=['DE'],
+            include_types=['PPLA'], non_cities=True)(items))
+        self.assertFalse(CityFilter(minimum_population=1)(items))
+
+    def testCountryFilter(self):
+        country_filter = CountryFilter(include=['FR', 'BE'], exclude=['BE'])
+        self.assertTrue(country_filter(['FR.11', 'Ile-de-France']))
+        self.assertFalse(country_filter(['BE.BRU', 'Brussels']))
+        self.assertFalse(country_filter(['DE', 'DEU']))
+
+
+class ReceiversTestCase(unittest.TestCase):
+    def testIsConnected(self):
+        self.assertTrue(is_connected(city_items_pre_import,
+            filter_non_cities))
+        self.assertFalse(has_other_receivers(city_items_pre_import,
+            filter_non_cities))
+
+        self.assertTrue(is_connected(signals.post_save, city_search_keys,
+            City))
+        self.assertTrue(is_connected(signals.post_save, city_search_keys))
+        self.assertFalse(is_connected(signals.post_save, city_search_keys,
+            Region))
+
+        with defer_denormalization():
+            self.assertFalse(is_connected(signals.post_save,
+                city_search_keys))
+
+
+class BatchSignalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.geonames = Geonames.__new__(Geonames)
+        self.geonames.file_path = os.path.join(self.directory, 'cities.txt')
+
+        with open(self.geonames.file_path, 'w') as f:
+            for i in range(1200):
+                f.write('%04d\tcity\n' % i)
+
+        self.batches = []
+        city_items_batch_pre_import.connect(self.receiver)
+
+    def tearDown(self):
+        city_items_batch_pre_import.disconnect(self.receiver)
+        shutil.rmtree(self.directory)
+
+    def receiver(self, sender, batch, **kwargs):
+        self.batches.append(len(batch))
+        batch[0] = None
+        del batch[-1]
+
+    def testSendBatches(self):
+        command = Command()
+        rows = command._send_batches(city_items_batch_pre_import,
+            self.geonames, self.geonames.parse())
+
+        ids = []
+        offsets = {}
+        for items in rows:
+            ids.append(int(items[0]))
+            offsets[ids[-1]] = command._resume_offset
+
+        self.assertEqual(self.batches, [500, 500, 200])
+        self.assertEqual(len(ids), 1200 - 6)
+        self.assertEqual(ids[:2], [1, 2])
+        self.assertEqual(ids[-1], 1198)
+
+        # checkpoints resume from the first row of the current batch
+        self.assertEqual(offsets[1], 0)
+        self.assertEqual(offsets[501], 500 * len('0000\tcity\n'))
+        self.assertEqual(command._resume_offset, None)
+
+
+class IncrementalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.country = Country(name=u'Incrementland', code2='IL')
+        self.country.save()
+        self.other_country = Country(name=u'Othercountry', code2='IO')
+        self.other_country.save()
+        self.region = Region(name=u'Incremental region', country=self.country,
+            geoname_code='01')
+        self.region.save()
+        self.city = City(name=u'Incremental city', country=self.country,
+            geoname_id=9970001)
+        self.city.save()
+        self.deleted = City(name=u'Deleted city', country=self.country,
+            geoname_id=9970002)
+        self.deleted.save()
+        self.moved = City(name=u'Moved city', country=self.country,
+            region=self.region, geoname_id=9970004)
+        self.moved.save()
+
+        self.directory = tempfile.mkdtemp()
+        files = {
+            'modifications': [
+                ['9970001', 'Incremental town', 'Incremental town', '',
+                    '1.5', '2.5', 'P', 'PPL', 'IL', '', '01', '', '', '',
+                    '100', '', '', '', '2012-01-01'],
+                ['9970003', 'Small town', 'Small town', '', '1.5', '2.5',
+                    'P', 'PPL', 'IL', '', '01', '', '', '', '100', '', '',
+                    '', '2012-01-01'],
+                ['9970004', 'Moved city', 'Moved city', '', '0.0', '0.0',
+                    'P', 'PPL', 'IO', '', '01', '', '', '', '100', '', '',
+                    '', '2012-01-01'],
+                ['9970005', 'New city', 'New city', '', '3.5', '4.5', 'P',
+                    'PPL', 'IL', '', '01', '', '', '', '20000', '', '', '',
+                    '2012-01-01'],
+            ],
+            'deletes': [['9970002', 'Deleted city', 'duplicate']],
+            'alternateNamesModifications': [
+                ['1', '9970001', 'en', 'Incremental village'],
+            ],
+            'alternateNamesDeletes': [['2', '9970001', 'wrong']],
+        }
+        for name, rows in files.items():
+            path = os.path.join(self.directory, '%s-2012-01-01.txt' % name)
+            with open(path, 'w') as f:
+                f.write(''.join('\t'.join(row) + '\n' for row in rows))
+
+        # download into the temporary directory instead of the package
+        self.data_dir = os.path.join(self.directory, 'data')
+        self.patched = []
+        self.patch(geonames, 'DATA_DIR', self.data_dir)
+        self.patch(cities_light_command, 'DATA_DIR', self.data_dir)
+
+        self.command = Command()
+        self.command.noinsert = False
+        self.command.bulk = False
+        self.command.parallel = 0
+        self.command._city_batch = []
+        self.command.widgets = []
+
+    def tearDown(self):
+        for module, name, value in reversed(self.patched):
+            setattr(module, name, value)
+
+        self.country.delete()
+        self.other_country.delete()
+        shutil.rmtree(self.directory)
+
+    def patch(self, module, name, value):
+        self.patched.append((module, name, getattr(module, name)))
+        setattr(module, name, value)
+
+    def testIncrementalDay(self):
+        self.command.incremental_day(datetime.date(2012, 1, 1),
+            'file://%s/' % self.directory)
+
+        city = City.objects.get(pk=self.city.pk)
+        self.assertEqual(city.name, u'Incremental town')
+        self.assertEqual(city.latitude, Decimal('1.5'))
+        self.assertEqual(city.region_id, self.region.pk)
+        self.assertEqual(city.alternate_names, u'Incremental village')
+
+        self.assertFalse(City.objects.filter(pk=self.deleted.pk).exists())
+
+        # smaller than the smallest city of CITY_SOURCES
+        self.assertFalse(City.objects.filter(geoname_id=9970003).exists())
+
+        # IO has no region 01
+        moved = City.objects.get(pk=self.moved.pk)
+        self.assertEqual((moved.country_id, moved.region_id),
+            (self.other_country.pk, None))
+
+        # inserted without loading the identity map of all cities
+        new = City.objects.get(geoname_id=9970005)
+        self.assertEqual((new.country_id, new.region_id, new.latitude),
+            (self.country.pk, self.region.pk, Decimal('3.5')))
+        self.assertFalse(hasattr(self.command, '_city_ids'))
+
+        self.assertEqual(os.listdir(self.data_dir), [])
+
+    def testIncrementalDate(self):
+        # a full import of the cities published on 2012-01-05
+        path = os.path.join(self.directory, 'cities15000.txt')
+        with open(path, 'w') as f:
+            f.write('\t'.join(['9970006', 'Full city', 'Full city', '',
+                '1.5', '2.5', 'P', 'PPL', 'IL', '', '01', '', '', '',
+                '20000', '', '', '', '2012-01-01']) + '\n')
+        timestamp = (datetime.datetime(2012, 1, 5, 12) -
+            datetime.datetime(1970, 1, 1)).total_seconds()
+        os.utime(path, (timestamp, timestamp))
+
+        url = 'file://%s' % path
+        self.patch(cities_light_command, 'SOURCES', [url])
+        self.patch(cities_light_command, 'CITY_SOURCES', [url])
+        self.patch(cities_light_command, 'TRANSLATION_SOURCES', [])
+        self.command.sources_import({'force_all': False, 'force': [],
+            'force_import_all': False, 'force_import': []})
+
+        self.assertTrue(City.objects.filter(geoname_id=9970006).exists())
+        state_path = os.path.join(self.data_dir, 'incremental_date')
+        with open(state_path) as f:
+            self.assertEqual(f.read(), '2012-01-04')
+
+        # the next incremental import starts with the day of the source
+        days = []
+        self.command.incremental_day = lambda day, base_url: days.append(day)
+        self.command.incremental_import(until=datetime.date(2012, 1, 7))
+        self.assertEqual(days, [datetime.date(2012, 1, 5),
+            datetime.date(2012, 1, 6)])
+        with open(state_path) as f:
+            self.assertEqual(f.read(), '2012-01-06')
+
+    def testCheckpoint(self):
+        path = os.path.join(self.directory, 'cities15000.txt')
+        lines = ['\t'.join([str(geoname_id), 'City %s' % geoname_id,
+            'City %s' % geoname_id, '', '1.5', '2.5', 'P', 'PPL', 'IL', '',
+            '01', '', '', '', '20000', '', '', '', '2012-01-01']) + '\n'
+            for geoname_id in range(9970011, 9970016)]
+        with open(path, 'w') as f:
+            f.write(''.join(lines))
+
+        url = 'file://%s' % path
+        self.patch(cities_light_command, 'SOURCES', [url])
+        self.patch(cities_light_command, 'CITY_SOURCES', [url])
+        self.patch(cities_light_command, 'TRANSLATION_SOURCES', [])
+        self.patch(cities_light_command, 'COMMIT_ROWS', 2)
+        options = {'force_all': False, 'force': [],
+            'force_import_all': False, 'force_import': []}
+
+        class Interrupted(Exception):
+            pass
+
+        imported = []
+        interrupt = [9970013]
+        city_import = self.command.city_import
+
+        def import_or_interrupt(items):
+            if items[0] in interrupt:
+                interrupt.remove(items[0])
+                raise Interrupted()
+            imported.append(items[0])
+            city_import(items)
+        self.command.city_import = import_or_interrupt
+
+        # interrupted after the first commit
+        self.assertRaises(Interrupted, self.command.sources_import, options)
+        self.assertEqual(imported, [9970011, 9970012])
+
+        file_path = os.path.join(self.data_dir, 'cities15000.txt')
+        checkpoint_path = file_path + '.checkpoint'
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        self.assertEqual(checkpoint, {
+            'offset': len(''.join(lines[:2])),
+            'batch': 1,
+            'size': os.path.getsize(file_path),
+            'mtime': os.path.getmtime(file_path),
+        })
+
+        # the source is not downloaded again, its import resumes
+        del imported[:]
+        self.command.sources_import(options)
+        self.assertEqual(imported, [9970013, 9970014, 9970015])
+        self.assertEqual(City.objects.filter(country=self.country,
+            geoname_id__gte=9970011).count(), 5)
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+        # checkpoints of another version of the source are ignored
+        for key, value in (('size', checkpoint['size'] + 1),
+                ('mtime', checkpoint['mtime'] + 1)):
+            with open(checkpoint_path, 'w') as f:
+                json.dump(dict(checkpoint, **{key: value}), f)
+
+            del imported[:]
+            self.command.sources_import(options)
+            self.assertEqual(imported, [])
+            self.assertFalse(os.path.exists(checkpoint_path))
+
+    def testPrefetch(self):
+        urls = []
+        for name, geoname_ids in (('cities15000.txt', [9970021]),
+                ('cities5000.txt', [9970022, 9970023])):
+            path = os.path.join(self.directory, name)
+            with open(path, 'w') as f:
+                f.write(''.join('\t'.join([str(geoname_id),
+                    'City %s' % geoname_id, 'City %s' % geoname_id, '', '1.5',
+                    '2.5', 'P', 'PPL', 'IL', '', '01', '', '', '', '20000', '',
+                    '', '', '2012-01-01']) + '\n'
+                    for geoname_id in geoname_ids))
+            urls.append('file://%s' % path)
+
+        broken = os.path.join(self.directory, 'broken.zip')
+        with open(broken, 'w') as f:
+            f.write('not a zip')
+
+        terminated = []
+
+        class ThreadPool(multiprocessing.pool.ThreadPool):
+            def terminate(self):
+                terminated.append(self)
+                super(ThreadPool, self).terminate()
+        self.patch(multiprocessing.pool, 'ThreadPool', ThreadPool)
+
+        imported = []
+        city_import = self.command.city_import
+
+        def record_import(items):
+            imported.append(items[0])
+            city_import(items)
+        self.command.city_import = record_import
+
+        self.patch(cities_light_command, 'SOURCES', urls)
+        self.patch(cities_light_command, 'CITY_SOURCES', urls)
+        self.patch(cities_light_command, 'TRANSLATION_SOURCES', [])
+        options = {'force_all': False, 'force': [],
+            'force_import_all': False, 'force_import': []}
+
+        # both sources are downloaded, and imported in the order of SOURCES
+        self.command.sources_import(options)
+        self.assertTrue(os.path.exists(os.path.join(self.data_dir,
+            'cities15000.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.data_dir,
+            'cities5000.txt')))
+        self.assertEqual(imported, [9970021, 9970022, 9970023])
+        self.assertEqual(terminated, [])
+
+        # the error of a source is raised once the previous ones are
+        # imported, and the downloads are stopped
+        del imported[:]
+        self.patch(cities_light_command, 'SOURCES', [urls[1],
+            'file://%s' % broken])
+        self.assertRaises(InvalidSource, self.command.sources_import,
+            dict(options, force_all=True))
+        self.assertEqual(imported, [9970022, 9970023])
+        self.assertEqual(len(terminated), 1)
+        self.assertEqual([name for name in os.listdir(self.data_dir)
+            if name.endswith('.part') or name.startswith('broken')], [])
+
+
+class DownloadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stand-in for the geonames server, supporting conditional and range
+    requests.
+    """
+    content = 'x' * 1000 + 'y' * 1000
+    etag = '"v1"'
+    last_modified = 'Sun, 01 Jan 2012 00:00:00 GMT'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+
+        if self.headers.getheader('if-none-match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        content = self.content
+        range = self.headers.getheader('range')
+        if range and self.headers.getheader('if-range') == self.etag:
+            start = int(range.split('=')[1].rstrip('-'))
+            content = content[start:]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', self.last_modified)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+            DownloadHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s/cities.zip' % self.server.server_port
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cities.zip')
+        self.geonames = Geonames.__new__(Geonames)
+        self.geonames.download_chunk_size = 100
+        DownloadHandler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def testConditionalDownload(self):
+        self.assertTrue(self.geonames.download(self.url, self.path))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), DownloadHandler.content)
+        self.assertEqual(os.path.getmtime(self.path), 1325376000)
+
+        self.assertFalse(self.geonames.download(self.url, self.path))
+        self.assertEqual(DownloadHandler.requests[1]['if-none-match'],
+            DownloadHandler.etag)
+
+        self.assertTrue(self.geonames.download(self.url, self.path,
+            force=True))
+
+    def testResumeDownload(self):
+        with open(self.path + '.part', 'wb') as f:
+            f.write(DownloadHandler.content[:1500])
+        with open(self.path + '.headers', 'w') as f:
+            json.dump({'etag': DownloadHandler.etag, 'complete': False}, f)
+
+        self.assertTrue(self.geonames.download(self.url, self.path))
+        self.assertEqual(DownloadHandler.requests[0]['range'], 'bytes=1500-')
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), DownloadHandler.content)
+        self.assertFalse(os.path.exists(self.path + '.part'))
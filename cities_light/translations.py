@@ -0,0 +1,245 @@
+"""
+Aggregation of alternate names parsed by the cities_light command.
+
+TranslationSpool
+    Collects (model, geoname_id, lang, name) entries like the translation_data
+    dict of the command, but within a memory budget: when the entries held in
+    memory exceed it, they are sorted and written as a run to a temporary
+    file. Iterating over the spool merges the runs and yields the names of
+    each geoname_id in turn, so that they can be applied to the database
+    without ever being all in memory.
+
+TranslationCache
+    Versioned binary cache of parsed translations, used by the cities_light
+    command with --hack-translations. It is keyed on the checksum of the
+    source file and on TRANSLATION_LANGUAGES, and is memory-mapped to be
+    streamed into the import.
+"""
+
+import hashlib
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+
+__all__ = ['TranslationSpool', 'TranslationCache']
+
+
+class TranslationSpool(object):
+    """
+    Disk-spilling aggregator of translation entries.
+
+    Entries are sorted by model, geoname_id and lang. Names of a given
+    language keep the order in which they were added.
+    """
+
+    # rough memory cost of an entry, on top of the length of its name
+    entry_size = 200
+
+    def __init__(self, budget, directory=None):
+        self.budget = budget
+        self.directory = directory
+        self.entries = []
+        self.size = 0
+        self.runs = []
+        self.count = 0
+
+    def add(self, model, geoname_id, lang, name):
+        """
+        Add an entry, spill the entries in memory if over budget.
+        """
+        self.entries.append((model, geoname_id, lang, self.count, name))
+        self.count += 1
+        self.size += self.entry_size + len(name)
+
+        if self.size > self.budget:
+            self.spill()
+
+    def spill(self):
+        """
+        Write the entries in memory as a sorted run to a temporary file.
+        """
+        self.entries.sort()
+
+        run = tempfile.TemporaryFile(prefix='cities_light',
+            dir=self.directory)
+        run.writelines('%s\t%s\t%s\t%s\t%s\n' % e for e in self.entries)
+        self.runs.append(run)
+
+        self.entries = []
+        self.size = 0
+
+    def read_run(self, run):
+        run.seek(0)
+        for line in run:
+            model, geoname_id, lang, i, name = line[:-1].split('\t', 4)
+            yield model, int(geoname_id), lang, int(i), name
+
+    def __iter__(self):
+        """
+        Yield (model, geoname_id, {lang: [names]}) sorted by model and
+        geoname_id.
+        """
+        self.entries.sort()
+
+        streams = [self.read_run(run) for run in self.runs]
+        streams.append(iter(self.entries))
+
+        groups = itertools.groupby(heapq.merge(*streams),
+            lambda e: (e[0], e[1]))
+
+        for (model, geoname_id), entries in groups:
+            data = {}
+            for entry in entries:
+                data.setdefault(entry[2], []).append(entry[4])
+
+            yield model, geoname_id, data
+
+    def close(self):
+        """
+        Delete the runs.
+        """
+        for run in self.runs:
+            run.close()
+
+        self.runs = []
+        self.entries = []
+        self.size = 0
+
+
+class TranslationCache(object):
+    """
+    Binary file of translation entries, keyed on the checksum of the source
+    file and on the set of languages.
+
+    The file starts with a header holding a format version, the key and the
+    number of entries. Each entry is a fixed size record (model index,
+    geoname_id, length of lang, length of name) followed by lang and name.
+    The file is memory-mapped when iterating, which yields the same groups as
+    TranslationSpool.
+    """
+
+    magic = 'CLTC'
+    version = 1
+    models = ('Country', 'Region', 'City')
+
+    header = struct.Struct('<4sH40sI')
+    record = struct.Struct('<BiBH')
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def make_key(cls, source_path, languages):
+        """
+        Return the sha1 of source_path and languages.
+        """
+        digest = hashlib.sha1()
+
+        with open(source_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                digest.update(chunk)
+
+        digest.update('\0'.join(sorted(languages)))
+        return digest.hexdigest()
+
+    def read_header(self):
+        """
+        Return (version, key, count) or None if there is no valid cache.
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path, 'rb') as f:
+            data = f.read(self.header.size)
+
+        if len(data) != self.header.size:
+            return None
+
+        magic, version, key, count = self.header.unpack(data)
+        if magic != self.magic:
+            return None
+
+        return version, key, count
+
+    def is_valid(self, key):
+        """
+        Return True if the cache exists for this format version and key.
+        """
+        header = self.read_header()
+        return header is not None and header[:2] == (self.version, key)
+
+    @property
+    def count(self):
+        header = self.read_header()
+        return header[2] if header else 0
+
+    def write(self, groups, key):
+        """
+        Write groups of (model, geoname_id, {lang: [names]}) to the cache.
+
+        The file is replaced atomically once complete.
+        """
+        models = dict((m, i) for i, m in enumerate(self.models))
+        tmp_path = self.path + '.tmp'
+        count = 0
+
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.version, key, count))
+
+            for model, geoname_id, data in groups:
+                for lang, names in data.items():
+                    for name in names:
+                        if isinstance(name, unicode):
+                            name = name.encode('utf-8')
+
+                        f.write(self.record.pack(models[model], geoname_id,
+                            len(lang), len(name)))
+                        f.write(lang)
+                        f.write(name)
+                        count += 1
+
+            f.seek(0)
+            f.write(self.header.pack(self.magic, self.version, key, count))
+
+        os.rename(tmp_path, self.path)
+
+    def __iter__(self):
+        """
+        Yield (model, geoname_id, {lang: [names]}) in the order they were
+        written.
+        """
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            offset = self.header.size
+            end = len(data)
+            current = None
+            group = None
+
+            while offset < end:
+                model, geoname_id, lang_length, name_length = \
+                    self.record.unpack_from(data, offset)
+                offset += self.record.size
+
+                lang = data[offset:offset + lang_length]
+                offset += lang_length
+                name = data[offset:offset + name_length]
+                offset += name_length
+
+                if (model, geoname_id) != current:
+                    if current is not None:
+                        yield self.models[current[0]], current[1], group
+
+                    current = model, geoname_id
+                    group = {}
+
+                group.setdefault(lang, []).append(name)
+
+            if current is not None:
+                yield self.models[current[0]], current[1], group
+        finally:
+            data.close()